@@ -36,12 +36,17 @@
 #@ String msg7 (visibility=MESSAGE, value="------------------------------------------------ Manual or Automatic threshold: ---------------------------------------------------", required=False)
 #@ Boolean manualThreshold (label="Apply manual threshold value:", description="Manual threshold",value=False, persist=True)
 #@ Integer thresholdValue (label="Threshold value:", value=100, persist=True)
+#@ String thresholdMethod (label="Automatic threshold method:", choices={"Interactive (threshold dialog)", "Default", "Huang", "Intermodes", "IsoData", "Li", "MaxEntropy", "Mean", "MinError", "Minimum", "Moments", "Otsu", "Percentile", "RenyiEntropy", "Shanbhag", "Triangle", "Yen"}, style="listBox", persist=True)
 #@ String msg8 (visibility=MESSAGE, value="                                                                          ", required=False)
 #@ String msg9 (visibility=MESSAGE, value="------------------------------------------------------------- Other: --------------------------------------------------------------", required=False)
 #@ Double timeLapse (label="Timelapse (min)", description="What is the timelapse between 2 images?",value=5, persist=False)
 #@ String FRETchoice (label="FRET metric:",choices={"FRET index = 100 x A/(A+D)   ", "FRET ratio = A/D   ", "FRET ratio = D/A" }, style="radioButtonHorizontal", persist=True)
 #@ Boolean calibrationBar (label="Display Calibration Bar ?", description="Calibration Bar",value=True, persist=True)
 #@ String msg10 (visibility=MESSAGE, value="                                                                          ", required=False)
+#@ String msg11 (visibility=MESSAGE, value="------------------------------------------------ Headless batch mode (optional): ------------------------------------------------", required=False)
+#@ String batchInput (label="Batch input (folder or glob, empty = interactive):", value="", required=False, persist=False)
+#@ String parameterFile (label="Parameter set / analysis preset (JSON):", value="", required=False, persist=False)
+#@ String msg12 (visibility=MESSAGE, value="                                                                          ", required=False)
 
 #@ UIService uiService
 #@ LogService log
@@ -52,14 +57,34 @@
 # ---------------------------------------------------------------------------
 
 # Python standard library
+import jarray
 import sys
 import os
 import csv
 import math
+import glob
+import json
+import hashlib
+import threading
+import shutil
+import time
 
 # Java AWT & charting
 from java.io import File
+from java.io import FileOutputStream
+from java.io import BufferedOutputStream
+from java.io import DataOutputStream
+from java.util.zip import ZipOutputStream
+from java.util.zip import ZipEntry
 from java.lang import Float
+from java.lang import Long
+from java.lang import Runtime
+from java.lang import System
+from java.lang import Throwable
+from java.util.concurrent import Callable
+from java.util.concurrent import Executors
+from java.util.concurrent import Semaphore
+from java.util.concurrent import TimeUnit
 from java.awt import Font
 from java.awt import Color
 from java.awt.image import BufferedImage
@@ -80,46 +105,63 @@ from org.jfree.data.xy import XYSeriesCollection
 from ij import IJ
 from ij import ImagePlus
 from ij import ImageStack
+from ij import VirtualStack
 from ij import Prefs
-from ij import WindowManager
 from ij.io import Opener
+from ij.io import FileSaver
 from ij.io import OpenDialog
+from ij.io import RoiEncoder
 from ij.process import ImageProcessor
+from ij.process import Blitter
 from ij.process import ColorProcessor
-from ij.process import ImageConverter
 from ij.process import AutoThresholder
 from ij.process import ImageStatistics
+from ij.process import FloatPolygon
+from ij.process import FloatProcessor
 from ij.gui import GenericDialog
 from ij.gui import WaitForUserDialog
 from ij.gui import YesNoCancelDialog
 from ij.gui import PlotWindow
 from ij.gui import Roi
-from ij.plugin import ZAxisProfiler
-from ij.plugin import ZProjector
+from ij.gui import PolygonRoi
 from ij.plugin import RGBStackMerge
 from ij.plugin import RGBStackConverter
 from ij.plugin import HyperStackReducer
 from ij.plugin import Duplicator
 from ij.plugin import RoiEnlarger
-from ij.plugin import ImageCalculator as IC
+from ij.plugin import Binner
 from ij.measure import ResultsTable
 from ij.measure import Measurements
 from ij.measure import Calibration
+from ij.measure import CurveFitter
+from ij.measure import Minimizer
 from ij.plugin.filter import ThresholdToSelection
 from ij.plugin.filter import Analyzer
+from ij.plugin.filter import RankFilters
+from ij.plugin.filter import BackgroundSubtracter
 from ij.plugin.frame import ThresholdAdjuster
 from fiji.util.gui import GenericDialogPlus
 
 # Bio-Formats / Loci
-from loci.formats import ImageReader
+from loci.formats import ChannelSeparator
 from loci.formats import MetadataTools
-from loci.plugins.in import ImporterOptions
-from loci.plugins import BF
-
-# CMCI Library (Kota Miura) for Bleach Correction
-from emblcmci import BleachCorrection_SimpleRatio
-from emblcmci import BleachCorrection_ExpoFit
-from emblcmci import BleachCorrection_MH
+from loci.formats import Memoizer
+from loci.formats import FormatTools
+from loci.formats.out import OMETiffWriter
+from loci.common import DataTools
+from net.imglib2.img.display.imagej import ImageJFunctions
+from net.imglib2.view import Views
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.algorithm.math import ImgMath
+from org.janelia.saalfeldlab.n5 import DataType
+from org.janelia.saalfeldlab.n5 import GzipCompression
+from org.janelia.saalfeldlab.n5 import N5FSWriter
+from org.janelia.saalfeldlab.n5.imglib2 import N5Utils
+from org.janelia.saalfeldlab.n5.zarr import N5ZarrWriter
+from com.google.gson import JsonParser
+from loci.plugins.util import ImageProcessorReader
+from loci.plugins.util import LociPrefs
+from ome.units import UNITS
 
 
 # ---------------------------------------------------------------------------
@@ -129,14 +171,117 @@ from emblcmci import BleachCorrection_MH
 # ImageJ preferences
 Prefs.blackBackground = True
 
-# Bio-Formats import settings
-SET_CONCAT = False
-SHOW_OME_XML = False
-AUTO_SCALE = False
-
 # Channel selection behavior
 SELECT_CHANNELS_INTERACTIVELY = True
 
+# Donor/acceptor loading: read each plane from disk on demand (virtual stack)
+# instead of loading the whole ZT hyperstack of each channel onto the heap.
+# In stack mode every plane is then read once (raw save, bleaching means and
+# masking in the same sweep), plus the first frame for the display range,
+# saturation and background ROI. In streaming mode the raw save and the
+# Simple Ratio / Exponential Fit means each read every plane once more
+LOAD_AS_VIRTUAL_STACK = True
+
+# Persistent cache of the parsed metadata and Bio-Formats reader state, keyed
+# by file path, size and modification time (empty string disables the cache)
+METADATA_CACHE_DIR = os.path.join(System.getProperty("user.home"), ".fret_lsm_cache")
+# Cache entries of files that changed or disappeared, or not used for this
+# number of days, are deleted when a file is opened
+METADATA_CACHE_MAX_AGE_DAYS = 30
+
+# Spectrum preview: longest edge (pixels) of the reduced preview used for the
+# ROI and the emission spectrum (0 = full resolution). The preview is read
+# from a lower pyramid level when the file has one, then averaged by bins
+# down to this size. With the exact option,
+# the spectrum is read at full resolution inside the ROI bounding box only.
+SPECTRUM_PREVIEW_SIZE = 512
+SPECTRUM_PREVIEW_EXACT_ROI = False
+
+# Output writing: TIFFs are written by a background queue while the next
+# stage runs; images waiting in the queue are capped to this many megabytes
+WRITE_QUEUE_MAX_MB = 2048
+
+# Streaming mode: every frame goes through PART 2 and PART 3 right away and
+# its planes and measurements are appended to the output files, so memory
+# does not grow with the number of frames. The outputs differ from the stack
+# mode in their file names only: the stacks are written as OME-TIFF
+# (STREAM_EXTENSION, e.g. "_c1thres.ome.tif" instead of "_c1thres.tif")
+STREAMING_MODE = False
+STREAM_EXTENSION = ".ome.tif"
+
+# Format of the 32-bit result stacks (thresholded donor/acceptor, FRET):
+# "tiff", or a gzip-compressed chunked container, "n5" or "zarr" (OME-Zarr),
+# with one XY tile of one frame per chunk so that frames can be read one
+# at a time. Chunks are written in parallel.
+CHUNKED_OUTPUT_FORMAT = "tiff"
+CHUNK_SIZE_XY = 512
+CHUNK_COMPRESSION_LEVEL = 6
+CHUNKED_DATASET = "0"
+# Calibration units as named by OME-NGFF
+NGFF_UNITS = {"micron": "micrometer", "um": "micrometer", u"\u00b5m": "micrometer",
+	"nm": "nanometer", "mm": "millimeter", "sec": "second", "s": "second",
+	"min": "minute", "ms": "millisecond"}
+
+# Multi-series files: 32-bit stack copies held by each series analysed in
+# parallel (used to size the worker pool from the heap)
+SERIES_HEAP_FACTOR = 4
+
+# Headless batch mode: spectral files and donor/acceptor TIF pairs picked up
+# from the batch input, and number of files/series analysed at once (0 = one
+# per core)
+BATCH_SPECTRAL_EXTENSIONS = (".lsm", ".czi")
+BATCH_DONOR_SUFFIX = "_c1.tif"
+BATCH_ACCEPTOR_SUFFIX = "_c2.tif"
+BATCH_WORKERS = 0
+
+# PART 2: once the background ROI and the thresholds are fixed for all the
+# remaining frames, process these frames in parallel (Prefs.getThreads())
+PARALLEL_FRAMES = True
+
+# Background subtraction, cell masking and FRET metric of a frame are done by
+# a fused pixel kernel (one pass per output image). Set to False to use the
+# multi-pass reference path (ImageJ commands), e.g. to check results. The
+# rolling ball background always uses the reference path.
+USE_FUSED_KERNEL = True
+# Without the fused kernel, the FRET metric is written straight into one
+# output stack. Set to True to write it over the thresholded acceptor stack
+# instead (once this one is saved), so that PART 3 allocates no stack at all
+# (only when a single metric is computed in PART 3)
+FRET_IN_PLACE = False
+
+# FRET metrics computed in the same run as the one chosen in the dialog, as
+# indexes into FRET_METRICS, e.g. (0, 1, 2) for all of them. This is the default
+# of params_["extraFRETMetrics"], which parameter sets may override with
+# indexes or names. Each metric gets its own stack, measurement file and
+# calibration bar, the thresholded images being computed only once
+EXTRA_FRET_METRICS = ()
+
+# Approximate rolling ball background ("Automatic (Rolling ball)"): the frame
+# is shrunk by ROLLING_BALL_SHRINK (minimum of each block), the background is
+# estimated with a ball of radius / ROLLING_BALL_SHRINK, then enlarged back.
+# A background is estimated every ROLLING_BALL_REFRESH frames and reused in
+# between; ROLLING_BALL_BLEND is the weight kept from the previous estimate
+# in a new one (slowly changing backgrounds). The error against the exact
+# rolling ball is measured on the first frame and every
+# ROLLING_BALL_CHECK_EVERY frames (0: first frame only), and saved in
+# ROLLING_BALL_ERROR_FILENAME.
+ROLLING_BALL_APPROXIMATE = False
+ROLLING_BALL_SHRINK = 4
+ROLLING_BALL_REFRESH = 1
+ROLLING_BALL_BLEND = 0.0
+ROLLING_BALL_CHECK_EVERY = 0
+ROLLING_BALL_ERROR_FILENAME = "rollingBallError.csv"
+
+# Analysis preset recorded in every output folder (channels, background ROI,
+# threshold values and method choices); give it as parameter set to replay it
+PRESET_FILENAME = "analysisPreset.json"
+
+# Cell/background separation is done on a raster mask. Set to True to also
+# trace the thresholded cells of every frame as a polygon ROI, saved in
+# CELL_ROIS_FILENAME (slow on fragmented masks)
+SAVE_CELL_ROIS = False
+CELL_ROIS_FILENAME = "cellROIs.zip"
+
 # Display settings
 DEFAULT_LUT = "Fire"
 
@@ -146,6 +291,11 @@ CORRECTION_METHODS = (
 	"Exponential Fit",
 	"Histogram Matching"
 )
+# Exponential Fit: parameters, fitted curve and residuals of each channel,
+# saved next to infoFile.csv. With BLEACH_FIT_REUSE, the parameters saved
+# by a previous run of the same dataset are used instead of a new fit
+BLEACH_FIT_FILENAME = "bleachFit.csv"
+BLEACH_FIT_REUSE = False
 
 # Available FRET metrics (must match UI choices)
 FRET_METRICS = (
@@ -162,6 +312,26 @@ BACKGROUND_SUBTRACTION_METHODS = (
 	"Automatic (Rolling ball)"
 )
 
+# Columns of the FRET measurement file (Analyzer: AREA + MEAN + STD_DEV)
+MEASUREMENT_COLUMNS = ("Area", "Mean", "StdDev")
+
+# Statistics computed in the single pass over a frame (StackStatsCache)
+FRAME_STATS_MEASUREMENTS = Measurements.AREA + Measurements.MEAN + Measurements.STD_DEV + Measurements.MIN_MAX
+# Radius of the NaN-aware median applied after the saturation masking:
+# 1 is the 3x3 "Despeckle" of ImageJ, 0 turns the despeckle off
+DESPECKLE_RADIUS = 1
+
+# Saturated pixels (%) of the display range, as "Enhance Contrast saturated=0.35"
+CONTRAST_SATURATED = 0.35
+
+# Automatic threshold: "Interactive" shows the threshold dialog, any other
+# choice is an AutoThresholder method applied to the histogram of every frame
+THRESHOLD_INTERACTIVE = "Interactive (threshold dialog)"
+# Also save the thresholds of every AutoThresholder method for all frames,
+# computed from the same cached histograms (to compare the methods)
+AUTO_THRESHOLD_COMPARE = False
+AUTO_THRESHOLD_COMPARE_FILENAME = "autoThresholds.csv"
+
 # CSV headers for background/threshold log file
 CSV_FIELDNAMES = (
 	"Frame #",
@@ -169,7 +339,8 @@ CSV_FIELDNAMES = (
 	"Donor Background",
 	"Acceptor Background",
 	"Min threshold",
-	"Max Threshold"
+	"Max Threshold",
+	"Threshold method"
 )
 
 # ---------------------------------------------------------------------------
@@ -210,30 +381,347 @@ def log_error(message):
 
 #### Fonctions for PART 1: data preparation & spectral channel selection
 
-def getImpIndexes(imagefile_, sizeC_, sizeZ_, sizeT_, idxseries_, selectIdx_, imageDir_):
+class SpectralReaderSession(object):
+	"""Bio-Formats reader session shared by all steps of PART 1.
+
+	The spectral LSM/CZI file is parsed once. The metadata probe, the spectrum
+	preview and the donor/acceptor extraction then read their planes from the
+	same open reader instead of re-opening the file with BF.openImagePlus.
+	"""
+
+	def __init__(self, imagefile_, cacheDir_=None):
+		self.path = imagefile_
+		self.omeMeta = MetadataTools.createOMEXMLMetadata()
+		baseReader_ = LociPrefs.makeImageReader()
+		memoizer_ = None
+		if cacheDir_:
+			# The Memoizer serializes the initialized reader on the first run
+			# and restores it on later runs instead of re-parsing the file
+			memoizer_ = Memoizer(baseReader_, 0, File(cacheDir_))
+			baseReader_ = memoizer_
+		self.reader = ImageProcessorReader(ChannelSeparator(baseReader_))
+		self.reader.setMetadataStore(self.omeMeta)
+		# Pyramid levels (tile scans) stay resolutions of their series instead of
+		# showing up as extra series that would be analysed as separate jobs
+		self.reader.setFlattenedResolutions(False)
+		self.reader.setId(imagefile_)
+		self.fromCache = memoizer_ is not None and memoizer_.isLoadedFromMemo()
+		self.series = 0
+		# Bio-Formats readers are not thread-safe (virtual stacks may be read
+		# from the display thread, series may be analysed in parallel)
+		self.lock = threading.RLock()
+		# Dimensions of every series, parsed once and shared by all readers
+		self.dims = self.getSeriesSummary()
+
+	def setSeries(self, idxSeries_):
+		"""Select the default series served by the session (0-based)."""
+		with self.lock:
+			self.series = idxSeries_
+			self.reader.setSeries(idxSeries_)
+
+	def getSeriesCount(self):
+		return len(self.dims)
+
+	def getSizeX(self, series_=None):
+		return self.dims[self._series(series_)]["sizeX"]
+
+	def getSizeY(self, series_=None):
+		return self.dims[self._series(series_)]["sizeY"]
+
+	def getSizeC(self, series_=None):
+		return self.dims[self._series(series_)]["sizeC"]
+
+	def getSizeZ(self, series_=None):
+		return self.dims[self._series(series_)]["sizeZ"]
+
+	def getSizeT(self, series_=None):
+		return self.dims[self._series(series_)]["sizeT"]
+
+	def _series(self, series_):
+		if series_ is None:
+			return self.series
+		return series_
+
+	def _selectSeries(self, series_):
+		# Must be called with the lock held
+		series_ = self._series(series_)
+		if self.reader.getSeries() != series_:
+			self.reader.setSeries(series_)
+
+	def openPlane(self, c_, z_, t_, series_=None, resolution_=0):
+		"""Read one plane (0-based C, Z, T indices) of a series (default: current).
+
+		resolution_ selects a lower level of a pyramidal series (0 = full size).
+		"""
+		with self.lock:
+			self._selectSeries(series_)
+			if resolution_ == 0:
+				return self.reader.openProcessors(self.reader.getIndex(z_, c_, t_))[0]
+			self.reader.setResolution(resolution_)
+			try:
+				return self.reader.openProcessors(self.reader.getIndex(z_, c_, t_))[0]
+			finally:
+				self.reader.setResolution(0)
+
+	def getPreviewResolution(self, minSize_, series_=None):
+		"""Smallest pyramid level whose longest edge is at least minSize_.
+
+		Returns (level, sizeX, sizeY); level 0 (full size) if the series has
+		no pyramid or minSize_ is 0.
+		"""
+		with self.lock:
+			self._selectSeries(series_)
+			best_ = (0, self.reader.getSizeX(), self.reader.getSizeY())
+			if minSize_ <= 0:
+				return best_
+			for level_ in range(1, self.reader.getResolutionCount()):
+				self.reader.setResolution(level_)
+				sizeX_ = self.reader.getSizeX()
+				sizeY_ = self.reader.getSizeY()
+				if max(sizeX_, sizeY_) >= minSize_:
+					best_ = (level_, sizeX_, sizeY_)
+			self.reader.setResolution(0)
+			return best_
+
+	def openRegion(self, c_, z_, t_, x_, y_, w_, h_, series_=None):
+		"""Read the (x_, y_, w_, h_) bounding box of one plane of a series."""
+		with self.lock:
+			self._selectSeries(series_)
+			return self.reader.openProcessors(self.reader.getIndex(z_, c_, t_), x_, y_, w_, h_)[0]
+
+	def getCalibration(self, series_=None):
+		"""Build an ImageJ calibration from the OME physical sizes of a series."""
+		series_ = self._series(series_)
+		cal_ = Calibration()
+		sizeX_ = self.omeMeta.getPixelsPhysicalSizeX(series_)
+		sizeY_ = self.omeMeta.getPixelsPhysicalSizeY(series_)
+		sizeZ_ = self.omeMeta.getPixelsPhysicalSizeZ(series_)
+		if sizeX_ is not None:
+			cal_.pixelWidth = sizeX_.value(UNITS.MICROMETER).doubleValue()
+			cal_.setUnit("micron")
+		if sizeY_ is not None:
+			cal_.pixelHeight = sizeY_.value(UNITS.MICROMETER).doubleValue()
+		if sizeZ_ is not None:
+			cal_.pixelDepth = sizeZ_.value(UNITS.MICROMETER).doubleValue()
+		timeIncrement_ = self.omeMeta.getPixelsTimeIncrement(series_)
+		if timeIncrement_ is not None:
+			cal_.frameInterval = timeIncrement_.value(UNITS.SECOND).doubleValue()
+			cal_.setTimeUnit("sec")
+		return cal_
+
+	def getSeriesSummary(self):
+		"""Return the dimensions and name of every series as a list of dictionaries."""
+		summary_ = []
+		with self.lock:
+			for i in range(self.reader.getSeriesCount()):
+				self.reader.setSeries(i)
+				summary_.append({"name": self.omeMeta.getImageName(i),
+					"sizeX": self.reader.getSizeX(), "sizeY": self.reader.getSizeY(),
+					"sizeC": self.reader.getSizeC(), "sizeZ": self.reader.getSizeZ(),
+					"sizeT": self.reader.getSizeT()})
+			self.reader.setSeries(self.series)
+		return summary_
+
+	def close(self):
+		with self.lock:
+			self.reader.close()
+
+
+def getCacheKey(imagefile_):
+	"""Path, size and modification time identifying a version of an acquisition."""
+	stat_ = os.stat(imagefile_)
+	return os.path.abspath(imagefile_), stat_.st_size, int(stat_.st_mtime)
+
+
+def readCacheSummary(cacheDir_):
+	"""Return the metadata.json of a cache entry, or None if missing or unreadable."""
+	try:
+		with open(os.path.join(cacheDir_, "metadata.json")) as jsonfile_:
+			return json.load(jsonfile_)
+	except (IOError, ValueError):
+		return None
+
+
+def isCacheSummaryValid(summary_):
+	"""True if the file recorded in a cache summary still has the same size and mtime."""
+	try:
+		return (summary_["path"], summary_["size"], summary_["mtime"]) == \
+			getCacheKey(summary_["path"])
+	except (KeyError, OSError):
+		return False
+
+
+def pruneMetadataCache():
+	"""Delete the cache entries of changed or deleted files, and the unused ones.
+
+	An entry is unused when its metadata.json was not read for
+	METADATA_CACHE_MAX_AGE_DAYS days; entries without a summary are deleted
+	after the same delay.
+	"""
+	if not METADATA_CACHE_DIR or not os.path.isdir(METADATA_CACHE_DIR):
+		return
+	oldest_ = time.time() - METADATA_CACHE_MAX_AGE_DAYS * 86400
+	for name_ in os.listdir(METADATA_CACHE_DIR):
+		cacheDir_ = os.path.join(METADATA_CACHE_DIR, name_)
+		if not os.path.isdir(cacheDir_):
+			continue
+		summary_ = readCacheSummary(cacheDir_)
+		summaryPath_ = os.path.join(cacheDir_, "metadata.json")
+		lastUse_ = os.path.getmtime(summaryPath_ if summary_ is not None else cacheDir_)
+		if lastUse_ < oldest_ or (summary_ is not None and not isCacheSummaryValid(summary_)):
+			shutil.rmtree(cacheDir_, True)
+			log_info("Metadata cache entry removed: %s" % cacheDir_)
+
+
+def getMetadataCacheDir(imagefile_):
+	"""Return the cache folder of an acquisition, keyed by path, size and mtime.
+
+	Returns None when the cache is disabled (METADATA_CACHE_DIR is empty).
+	"""
+	if not METADATA_CACHE_DIR:
+		return None
+	key_ = u"%s|%d|%d" % getCacheKey(imagefile_)
+	cacheDir_ = os.path.join(METADATA_CACHE_DIR, hashlib.md5(key_.encode("utf-8")).hexdigest())
+	if not os.path.exists(cacheDir_):
+		os.makedirs(cacheDir_)
+	return cacheDir_
+
+
+def openReaderSession(imagefile_):
+	"""Open a reader session, reusing the metadata cache of earlier runs.
+
+	A metadata.json file next to the Bio-Formats memo records the key of the
+	cache entry and the dimensions of every series of the acquisition. The
+	memo is only trusted when this summary matches the file being opened and
+	the series read from the memo; otherwise the entry is rebuilt.
+	"""
+	pruneMetadataCache()
+	cacheDir_ = getMetadataCacheDir(imagefile_)
+	session_ = SpectralReaderSession(imagefile_, cacheDir_)
+	if cacheDir_ is None:
+		return session_
+	path_, size_, mtime_ = getCacheKey(imagefile_)
+	summary_ = readCacheSummary(cacheDir_)
+	if session_.fromCache:
+		if summary_ is not None and summary_.get("path") == path_ \
+				and isCacheSummaryValid(summary_) \
+				and summary_.get("series") == session_.dims:
+			# Keep the last use of the entry for pruneMetadataCache
+			os.utime(os.path.join(cacheDir_, "metadata.json"), None)
+			log_info("Reader state restored from metadata cache: %s" % cacheDir_)
+			return session_
+		log_warning("Metadata cache does not match the file, rebuilding it: %s" % cacheDir_)
+		session_.close()
+		shutil.rmtree(cacheDir_, True)
+		os.makedirs(cacheDir_)
+		session_ = SpectralReaderSession(imagefile_, cacheDir_)
+	summary_ = {"path": path_, "size": size_, "mtime": mtime_, "series": session_.dims}
+	with open(os.path.join(cacheDir_, "metadata.json"), "w") as jsonfile:
+		json.dump(summary_, jsonfile, indent=2)
+	log_info("Metadata cache created: %s" % cacheDir_)
+	return session_
+
+
+class ReaderVirtualStack(VirtualStack):
+	"""Virtual stack serving the ZT planes of one channel from a reader session.
+
+	Each plane is read from disk when ImageJ asks for it and is not kept by
+	the stack, so peak memory is set by the few planes in use rather than by
+	the length of the movie. Slices are ordered Z first, then T.
+	"""
+
+	def __init__(self, session_, idxChannel_, idxSeries_):
+		VirtualStack.__init__(self, session_.getSizeX(idxSeries_),
+			session_.getSizeY(idxSeries_), None, "")
+		self.session = session_
+		self.channel = idxChannel_ - 1
+		self.series = idxSeries_
+		self.sizeZ = session_.getSizeZ(idxSeries_)
+		self.sizeT = session_.getSizeT(idxSeries_)
+
+	def getProcessor(self, n):
+		t_, z_ = divmod(n - 1, self.sizeZ)
+		return self.session.openPlane(self.channel, z_, t_, self.series)
+
+	def getSize(self):
+		return self.sizeZ * self.sizeT
+
+	def getSliceLabel(self, n):
+		return None
+
+
+def getPreviewStack(session_, t_, previewSize_):
+	"""Build a reduced, Z max-projected preview of all spectral channels.
+
+	The planes are read from the smallest pyramid level that is still at
+	least previewSize_ wide, when the file has one, then averaged by
+	integer bins (Binner) down to previewSize_. Only one plane is held in
+	memory at a time.
+
+	Returns
+	-------
+	stack_ : ImageStack
+		One preview slice per spectral channel.
+	scale_ : float
+		Size of a preview pixel in full-resolution pixels.
+	"""
+	level_, levelW_, levelH_ = session_.getPreviewResolution(previewSize_)
+	bin_ = 1
+	if previewSize_ > 0:
+		bin_ = max(1, int(math.ceil(max(levelW_, levelH_) / float(previewSize_))))
+	previewW_ = max(1, levelW_ // bin_)
+	previewH_ = max(1, levelH_ // bin_)
+	scale_ = session_.getSizeX() / float(levelW_) * bin_
+	stack_ = ImageStack(previewW_, previewH_)
+	for c in range(session_.getSizeC()):
+		proj_ = None
+		for z in range(session_.getSizeZ()):
+			ip_ = session_.openPlane(c, z, t_, None, level_)
+			if bin_ > 1:
+				ip_ = Binner().shrink(ip_, bin_, bin_, Binner.AVERAGE)
+			if proj_ is None:
+				proj_ = ip_
+			else:
+				proj_.copyBits(ip_, 0, 0, Blitter.MAX)
+		stack_.addSlice("C=%d" % c, proj_)
+	return stack_, scale_
+
+
+def getSpectrumExact(session_, t_, roiBounds_):
+	"""Mean intensity per channel of the Z max projection inside a bounding box."""
+	means_ = []
+	for c in range(session_.getSizeC()):
+		proj_ = None
+		for z in range(session_.getSizeZ()):
+			ip_ = session_.openRegion(c, z, t_, roiBounds_.x, roiBounds_.y,
+				roiBounds_.width, roiBounds_.height)
+			if proj_ is None:
+				proj_ = ip_
+			else:
+				proj_.copyBits(ip_, 0, 0, Blitter.MAX)
+		means_.append(proj_.getStats().mean)
+	return means_
+
+
+def getImpIndexes(session_, selectIdx_, imageDir_, writer_):
 	"""Determine donor and acceptor channel indices from a spectral LSM image.
 
-	A Z-projection is generated for the selected series, and the user is asked
-	to draw a ROI containing the fluorescent signal. The mean intensity across
-	all spectral channels is then plotted to display the emission spectrum.
-	The user selects donor and acceptor channel indices based on this plot.
+	A reduced Z-projection preview is generated for the selected series, and
+	the user is asked to draw a ROI containing the fluorescent signal. The
+	mean intensity across all spectral channels is then plotted to display
+	the emission spectrum. The user selects donor and acceptor channel
+	indices based on this plot.
 
 	Parameters
 	----------
-	imagefile_ : str
-		Path to the spectral LSM image.
-	sizeC_ : int
-		Number of channels in the spectral stack.
-	sizeZ_ : int
-		Number of Z-slices.
-	sizeT_ : int
-		Number of time frames.
-	idxseries_ : int
-		Index of the series to analyze.
+	session_ : SpectralReaderSession
+		Open reader session on the spectral LSM image (series already selected).
 	selectIdx_ : bool
 		If True, interactively select donor/acceptor channels.
 	imageDir_ : str
 		Directory used to save  outputs.
+	writer_ : AsyncTiffWriter
+		Output queue used to save the spectrum plot.
 
 	Returns
 	-------
@@ -243,19 +731,17 @@ def getImpIndexes(imagefile_, sizeC_, sizeZ_, sizeT_, idxseries_, selectIdx_, im
 		Selected acceptor channel index.
 	"""
 	log_step("Channel selection from spectral LSM")
-	log_info("Loading series %d for channel profile extraction" % idxseries_)
-
-	options = ImporterOptions()
-	options.setId(imagefile_)
-	options.setSeriesOn(idxseries_, True)
-	options.setZBegin(idxseries_, 0)
-	options.setZEnd(idxseries_, sizeZ_ - 1)
-	options.setTBegin(idxseries_, int(sizeT_ / 2))
-	options.setTEnd(idxseries_, int(sizeT_ / 2))
-	impsLSM = BF.openImagePlus(options)
-
-	IJ.run(impsLSM[0], "Grays", "stack")
-	impProj_ = ZProjector.run(impsLSM[0], "max")
+	log_info("Loading series %d for channel profile extraction" % session_.series)
+
+	sizeC_ = session_.getSizeC()
+	tMid_ = int(session_.getSizeT() / 2)
+	stackPreview, scale = getPreviewStack(session_, tMid_, SPECTRUM_PREVIEW_SIZE)
+	if scale > 1:
+		log_info("Spectrum preview reduced %.3g times" % scale)
+	impProj_ = ImagePlus(os.path.basename(session_.path), stackPreview)
+	impProj_.setDimensions(sizeC_, 1, 1)
+	impProj_.setOpenAsHyperStack(True)
+	IJ.run(impProj_, "Grays", "stack")
 	IJ.run(impProj_, "Enhance Contrast", "saturated=0.35")
 
 	idxDonor_ = 3
@@ -270,16 +756,24 @@ def getImpIndexes(imagefile_, sizeC_, sizeZ_, sizeT_, idxseries_, selectIdx_, im
 		roi_ = impProj_.getRoi()
 		
 		if roi_ is None:
-			IJ.run(impProj_, "Select All", "")
+			roi_ = Roi(0, 0, impProj_.getWidth(), impProj_.getHeight())
+
+		if SPECTRUM_PREVIEW_EXACT_ROI:
+			bounds_ = roi_.getBounds()
+			x_ = int(bounds_.x * scale)
+			y_ = int(bounds_.y * scale)
+			bounds_.setBounds(x_, y_,
+				min(int(math.ceil(bounds_.width * scale)), session_.getSizeX() - x_),
+				min(int(math.ceil(bounds_.height * scale)), session_.getSizeY() - y_))
+			yvalues = getSpectrumExact(session_, tMid_, bounds_)
 		else:
-			impsLSM[0].setRoi(roi_)
-
-		impsLSM[0].setCalibration(Calibration())
-		impsLSM[0].setDimensions(1, 1, sizeC_)
-		plot = ZAxisProfiler.getPlot(impsLSM[0])
-		plot.setXYLabels("Channel", "Mean")
-		xvalues = plot.getXValues()
-		yvalues = plot.getYValues()
+			yvalues = []
+			for c in range(sizeC_):
+				ipC_ = stackPreview.getProcessor(c + 1)
+				ipC_.setRoi(roi_)
+				yvalues.append(ipC_.getStats().mean)
+				ipC_.resetRoi()
+		xvalues = range(1, sizeC_ + 1)
 
 		series = XYSeries("Mean intensity channel")
 		for i in range(len(xvalues)):
@@ -307,7 +801,8 @@ def getImpIndexes(imagefile_, sizeC_, sizeZ_, sizeT_, idxseries_, selectIdx_, im
 		impPlot.setImage(imagePlot)
 
 		# Save spectrum image alongside analysis folder
-		IJ.saveAs(impPlot, "TIFF", os.path.join(imageDir_, "channel_spectrum.tif"))
+		# (a copy is queued: the plot window is closed before it is written)
+		writer_.submit(impPlot.duplicate(), os.path.join(imageDir_, "channel_spectrum.tif"))
 		impPlot.show()
 
 		gui = GenericDialog("Select FRET donor/acceptor channels")
@@ -324,23 +819,41 @@ def getImpIndexes(imagefile_, sizeC_, sizeZ_, sizeT_, idxseries_, selectIdx_, im
 		log_info("Selected donor channel: %d" % idxDonor_)
 		log_info("Selected acceptor channel: %d" % idxAcceptor_)
 
-	for i in range(len(impsLSM)):
-		impsLSM[i].flush()
+	impProj_.flush()
 
 	return idxDonor_, idxAcceptor_
 
 
-def extractImpFromIndex(imagefile_, idxChannel_, idxSeries_):
-	"""Extract a single-channel ZCT hyperstack from a spectral LSM file."""
-	options = ImporterOptions()
-	options.setId(imagefile_)
-	options.setSeriesOn(idxSeries_, True)
-	options.setAutoscale(AUTO_SCALE)
-	options.setShowOMEXML(SHOW_OME_XML)
-	options.setConcatenate(SET_CONCAT)
-	options.setCBegin(idxSeries_, idxChannel_ - 1)
-	options.setCEnd(idxSeries_, idxChannel_ - 1)
-	return BF.openImagePlus(options)[0]
+def extractImpsFromIndexes(session_, idxChannels_, virtual_, idxSeries_=None):
+	"""Extract single-channel ZT hyperstacks from the open spectral session.
+
+	All requested channels are read in the same sweep over Z and T, so each
+	position of the file is visited only once for donor and acceptor. In
+	virtual mode nothing is read here: planes are served on demand by a
+	ReaderVirtualStack and the session must stay open while they are used.
+	"""
+	if idxSeries_ is None:
+		idxSeries_ = session_.series
+	sizeZ_ = session_.getSizeZ(idxSeries_)
+	sizeT_ = session_.getSizeT(idxSeries_)
+	if virtual_:
+		stacks_ = [ReaderVirtualStack(session_, c, idxSeries_) for c in idxChannels_]
+	else:
+		stacks_ = [ImageStack(session_.getSizeX(idxSeries_), session_.getSizeY(idxSeries_))
+			for c in idxChannels_]
+		for t in range(sizeT_):
+			for z in range(sizeZ_):
+				for i in range(len(idxChannels_)):
+					stacks_[i].addSlice(session_.openPlane(idxChannels_[i] - 1, z, t, idxSeries_))
+	imps_ = []
+	for i in range(len(idxChannels_)):
+		title_ = "%s - C=%d" % (os.path.basename(session_.path), idxChannels_[i] - 1)
+		imp_ = ImagePlus(title_, stacks_[i])
+		imp_.setDimensions(1, sizeZ_, sizeT_)
+		imp_.setOpenAsHyperStack(sizeZ_ > 1 and sizeT_ > 1)
+		imp_.setCalibration(session_.getCalibration(idxSeries_))
+		imps_.append(imp_)
+	return imps_
 
 
 def adjustSizeNum(S_, length_):
@@ -385,123 +898,1059 @@ def subtractBG(imp_, roi_):
 	return mean_
 
 
-def applyROI2NAN(imp_, roi_):
-	"""Fill a ROI with NaN values in a 32-bit image."""
+def saveRoisZip(rois_, path_):
+	"""Write ROIs (at least one) to a zip file read by the ROI Manager, without any ROI Manager (headless)."""
+	zip_ = ZipOutputStream(BufferedOutputStream(FileOutputStream(path_)))
+	out_ = DataOutputStream(zip_)
+	try:
+		encoder_ = RoiEncoder(out_)
+		for roi_ in rois_:
+			zip_.putNextEntry(ZipEntry(roi_.getName() + ".roi"))
+			encoder_.write(roi_)
+			out_.flush()
+	finally:
+		out_.close()
+
+
+def getBackgroundMask(ip_, minthres_, maxthres_):
+	"""Return the byte mask (255) of the pixels outside [minthres_, maxthres_], NaN included."""
+	ip_.resetRoi()
+	ip_.setThreshold(minthres_, maxthres_, ImageProcessor.NO_LUT_UPDATE)
+	mask_ = ip_.createMask()
+	ip_.resetThreshold()
+	mask_.invert()
+	return mask_
+
+
+def getMeanInMask(ip_, mask_):
+	"""Mean gray intensity of the pixels of a mask (NaN ignored)."""
+	ip_.setRoi(0, 0, ip_.getWidth(), ip_.getHeight())
+	ip_.setMask(mask_)
+	mean_ = ImageStatistics.getStatistics(ip_, Measurements.MEAN, None).mean
+	ip_.resetRoi()
+	return mean_
+
+
+def getMeanInROI(imp_, roi_):
+	"""Mean gray intensity inside a ROI, the image being left without selection."""
+	imp_.setRoi(roi_)
+	mean_ = imp_.getStatistics(Measurements.MEAN).mean
+	imp_.deleteRoi()
+	return mean_
+
+
+def subtractBGMask(imp_, mask_):
+	"""Subtract the mean gray intensity measured inside a mask from an image."""
 	ip_ = imp_.getProcessor()
-	ip_.setColor(float("nan"))
-	ip_.fill(roi_)
-	IJ.run(imp_, "Select None", "")
-	return
+	mean_ = getMeanInMask(ip_, mask_)
+	ip_.subtract(mean_)
+	return mean_
 
 
-def bleachCorrection(imp_, CorrectionMethodIdx_, backROI_):
-	"""Apply photobleaching correction to a time-lapse stack."""
-	impcorrected = imp_.duplicate()
-
-	if CorrectionMethodIdx_ == 0:
-		imp_.setRoi(backROI_)
-		mean_ = imp_.getStatistics(Measurements.MEAN).mean
-		imp_.killRoi()
-		BCSR = BleachCorrection_SimpleRatio(impcorrected, mean_)
-		BCSR.correctBleach()
-	elif CorrectionMethodIdx_ == 1:
-		BCEF = BleachCorrection_ExpoFit(impcorrected)
-		BCEF.core()
-		impfit = WindowManager.getImage("y = a*exp(-bx) + c")
-		if impfit is not None:
-			impfit.hide()
-			impfit.close()
-	elif CorrectionMethodIdx_ == 2:
-		BCMH = BleachCorrection_MH(impcorrected)
-		BCMH.doCorrection()
-
-	return impcorrected
-
-
-def applyThreshold(imp_, minthres_, maxthres_):
-	"""Apply a raw threshold on an image and set background pixels to NaN."""
-	IJ.setRawThreshold(imp_, minthres_, maxthres_, None)
-	IJ.run(imp_, "NaN Background", "")
-	IJ.run(imp_, "Despeckle", "")
+def applyMask2NAN(imp_, mask_):
+	"""Fill the pixels of a mask with NaN values in a 32-bit image."""
+	ip_ = imp_.getProcessor()
+	ip_.resetRoi()
+	ip_.setValue(Float.NaN)
+	ip_.fill(mask_)
 	return
 
+
+def getCellROI(imp_, minthres_, maxthres_):
+	"""Trace the pixels within [minthres_, maxthres_] as a selection (None if empty)."""
+	ip_ = imp_.getProcessor()
+	ip_.setThreshold(minthres_, maxthres_, ImageProcessor.NO_LUT_UPDATE)
+	roi_ = ThresholdToSelection.run(imp_)
+	ip_.resetThreshold()
+	return roi_
+
+
+def getRollingBallBackground(ip_, radius_):
+	"""Exact rolling-ball background of a 32-bit frame, as "Subtract Background..."."""
+	background_ = ip_.duplicate()
+	BackgroundSubtracter().rollingBallBackground(background_, radius_, True, False, False, True, True)
+	return background_
+
+
+def getApproxRollingBallBackground(ip_, radius_, shrink_):
+	"""Rolling-ball background estimated on the frame shrunk by shrink_, then enlarged.
+
+	NaN pixels are given the minimum of the frame first, so that they
+	cannot raise the background. The frame is padded to a multiple of
+	shrink_ by repeating its last column and row, as Binner drops the
+	remainder, so that the enlarged background stays registered with the
+	frame; the padding is cropped off at the end.
+	"""
+	width_ = ip_.getWidth()
+	height_ = ip_.getHeight()
+	work_ = ip_.duplicate()
+	nanPixels_ = getBackgroundMask(work_, -Float.MAX_VALUE, Float.MAX_VALUE)
+	work_.setValue(getFrameStats(ip_).min)
+	work_.fill(nanPixels_)
+	work_.resetRoi()
+	paddedWidth_ = -(-width_ // shrink_) * shrink_
+	paddedHeight_ = -(-height_ // shrink_) * shrink_
+	if paddedWidth_ > width_ or paddedHeight_ > height_:
+		padded_ = work_.createProcessor(paddedWidth_, paddedHeight_)
+		padded_.insert(work_, 0, 0)
+		if paddedWidth_ > width_:
+			work_.setRoi(width_ - 1, 0, 1, height_)
+			padded_.insert(work_.crop().resize(paddedWidth_ - width_, height_), width_, 0)
+		if paddedHeight_ > height_:
+			padded_.setRoi(0, height_ - 1, paddedWidth_, 1)
+			padded_.insert(padded_.crop().resize(paddedWidth_, paddedHeight_ - height_), 0, height_)
+			padded_.resetRoi()
+		work_ = padded_
+	small_ = Binner().shrink(work_, shrink_, shrink_, Binner.MIN)
+	BackgroundSubtracter().rollingBallBackground(small_, max(1.0, float(radius_) / shrink_),
+		True, False, False, True, True)
+	small_.setInterpolationMethod(ImageProcessor.BILINEAR)
+	background_ = small_.resize(paddedWidth_, paddedHeight_, True)
+	if paddedWidth_ > width_ or paddedHeight_ > height_:
+		background_.setRoi(0, 0, width_, height_)
+		background_ = background_.crop()
+	return background_
+
+
+class RollingBallEstimator(object):
+	"""Approximate rolling-ball background subtraction of the frames of one channel.
+
+	The background is estimated by getApproxRollingBallBackground, and
+	refreshed/blended across frames as set by ROLLING_BALL_REFRESH and
+	ROLLING_BALL_BLEND. Without reuse (isStateless), frames may be given
+	in any order and from several threads; otherwise they must come in
+	frame order. The maximum and mean absolute errors of the estimate
+	against the exact rolling ball are kept in errors for the checked frames.
+	"""
+
+	def __init__(self, channel_, radius_):
+		self.channel = channel_
+		self.radius = radius_
+		self.background = None
+		self.errors = []
+
+	def isStateless(self):
+		return ROLLING_BALL_REFRESH <= 1 and ROLLING_BALL_BLEND <= 0
+
+	def subtract(self, ip_, slic_):
+		"""Subtract the background estimate from the frame slic_ (0-based), in place."""
+		if self.isStateless():
+			background_ = getApproxRollingBallBackground(ip_, self.radius, ROLLING_BALL_SHRINK)
+		else:
+			if self.background is None or slic_ % max(1, ROLLING_BALL_REFRESH) == 0:
+				estimate_ = getApproxRollingBallBackground(ip_, self.radius, ROLLING_BALL_SHRINK)
+				if self.background is not None and ROLLING_BALL_BLEND > 0:
+					estimate_.multiply(1.0 - ROLLING_BALL_BLEND)
+					previous_ = self.background.duplicate()
+					previous_.multiply(ROLLING_BALL_BLEND)
+					estimate_.copyBits(previous_, 0, 0, Blitter.ADD)
+				self.background = estimate_
+			background_ = self.background
+		if slic_ == 0 or (ROLLING_BALL_CHECK_EVERY > 0 and slic_ % ROLLING_BALL_CHECK_EVERY == 0):
+			error_ = getRollingBallBackground(ip_, self.radius)
+			error_.copyBits(background_, 0, 0, Blitter.DIFFERENCE)
+			stats_ = getFrameStats(error_)
+			self.errors.append((slic_ + 1, stats_.max, stats_.mean))
+			log_info("Approximate rolling ball (%s), frame %d: max |error| = %.2f, mean = %.2f"
+				% (self.channel, slic_ + 1, stats_.max, stats_.mean))
+		ip_.copyBits(background_, 0, 0, Blitter.SUBTRACT)
+
+
+def saveRollingBallErrors(estimators_, path_):
+	"""Write the errors of the approximate rolling ball of each channel to a CSV file."""
+	with open(path_, "wb") as csvfile_:
+		writer_ = csv.writer(csvfile_)
+		writer_.writerow(["Channel", "Frame", "MaxAbsError", "MeanAbsError"])
+		for estimator_ in estimators_:
+			for frame_, max_, mean_ in sorted(estimator_.errors):
+				writer_.writerow([estimator_.channel, frame_, max_, mean_])
+
+
+def needsBackgroundROI(params_):
+	"""True if the analysis needs a background ROI (ROI subtraction or Simple Ratio correction)."""
+	return params_["ChoiceSub"] == BACKGROUND_SUBTRACTION_METHODS[1] \
+		or (params_["bleachCorr"] and params_["CorrectionMethod"] == CORRECTION_METHODS[0])
+
+
+class BleachModel(object):
+	"""Photobleaching correction of one channel by one scale factor per frame.
+
+	The model is fitted once on the whole timelapse, before the frame loop.
+	correct() then rescales a frame in place around the background:
+	(x - background) * factor + background. It keeps no state, so frames
+	may be corrected in any order and from several threads.
+	"""
+
+	def __init__(self, channel_, factors_, background_=0.0):
+		self.channel = channel_
+		self.factors = factors_
+		self.background = background_
+		# Fitted models: frame means, fitted values and (a, b, c, R^2)
+		self.means = None
+		self.fitted = None
+		self.fit = None
+
+	def correct(self, ip_, slic_):
+		"""Correct the frame slic_ (0-based), in place."""
+		factor_ = self.factors[slic_]
+		if factor_ == 1.0:
+			return
+		if self.background != 0:
+			ip_.subtract(self.background)
+		ip_.multiply(factor_)
+		if self.background != 0:
+			ip_.add(self.background)
+
+
+def getFrameMeans(stack_):
+	"""Mean intensity of every frame of a stack, as a list of floats.
+
+	Only Measurements.MEAN is asked for, and only the value is kept, so no
+	histogram of the raw frames stays in memory.
+	"""
+	return [ImageStatistics.getStatistics(stack_.getProcessor(slic_ + 1), Measurements.MEAN,
+		None).mean for slic_ in range(stack_.getSize())]
+
+
+def getSimpleRatioModel(channel_, means_, background_):
+	"""BleachModel of the "Simple Ratio" method, as BleachCorrection_SimpleRatio.
+
+	Each frame is scaled by (I0 - background) / (It - background), with It the
+	mean intensity of the frame t (means_, see getFrameMeans).
+	"""
+	reference_ = means_[0] - background_
+	factors_ = []
+	for mean_ in means_:
+		signal_ = mean_ - background_
+		factors_.append(reference_ / signal_ if signal_ > 0 and reference_ > 0 else 1.0)
+	return BleachModel(channel_, factors_, background_)
+
+
+def fitExponentialDecay(means_):
+	"""Fit y = a*exp(-bx) + c to a series of frame means, without any window.
+
+	Returns (a, b, c, R^2), or None if the fit failed.
+	"""
+	x_ = jarray.array([float(t_) for t_ in range(len(means_))], "d")
+	y_ = jarray.array([float(m_) for m_ in means_], "d")
+	cf_ = CurveFitter(x_, y_)
+	cf_.doFit(CurveFitter.EXP_WITH_OFFSET)
+	if cf_.getStatus() != Minimizer.SUCCESS:
+		log_warning("Exponential fit of the bleaching failed: " + cf_.getStatusString())
+		return None
+	a_, b_, c_ = cf_.getParams()[:3]
+	return a_, b_, c_, cf_.getRSquared()
+
+
+def getExponentialModel(channel_, means_, fit_=None):
+	"""BleachModel of the "Exponential Fit" method, as BleachCorrection_ExpoFit.
+
+	The mean intensity of every frame (means_, see getFrameMeans) is fitted
+	by y = a*exp(-bx) + c, unless fit_ (a, b, c, R^2) is given, and each
+	frame is scaled by y(0) / y(t).
+	"""
+	nbSlice_ = len(means_)
+	if fit_ is None:
+		fit_ = fitExponentialDecay(means_)
+	if fit_ is None:
+		return BleachModel(channel_, [1.0] * nbSlice_)
+	a_, b_, c_ = fit_[:3]
+	fitted_ = [a_ * math.exp(-b_ * t_) + c_ for t_ in range(nbSlice_)]
+	factors_ = [fitted_[0] / y_ if y_ > 0 else 1.0 for y_ in fitted_]
+	model_ = BleachModel(channel_, factors_)
+	model_.means = means_
+	model_.fitted = fitted_
+	model_.fit = fit_
+	log_info("Bleaching fit (%s): y = %.4g*exp(-%.4gx) + %.4g, R^2 = %.4f"
+		% ((channel_,) + tuple(fit_)))
+	return model_
+
+
+def saveBleachFit(models_, path_):
+	"""Write the exponential fit of each channel with its residual per frame (CSV)."""
+	with open(path_, "wb") as csvfile_:
+		writer_ = csv.writer(csvfile_)
+		writer_.writerow(["Channel", "Frame", "Mean", "Fit", "Residual", "Factor",
+			"a", "b", "c", "RSquared"])
+		for model_ in models_:
+			if model_.fit is None:
+				continue
+			for slic_, mean_ in enumerate(model_.means):
+				writer_.writerow([model_.channel, slic_ + 1, mean_, model_.fitted[slic_],
+					mean_ - model_.fitted[slic_], model_.factors[slic_]] + list(model_.fit))
+
+
+def loadBleachFit(path_, nbSlice_):
+	"""Read the fit parameters saved by saveBleachFit: {channel: (a, b, c, R^2)}.
+
+	Channels fitted on another number of frames are left out.
+	"""
+	fits_ = {}
+	frames_ = {}
+	if not os.path.isfile(path_):
+		return fits_
+	with open(path_, "rb") as csvfile_:
+		for row_ in csv.DictReader(csvfile_):
+			channel_ = row_["Channel"]
+			fits_[channel_] = tuple(float(row_[k_]) for k_ in ("a", "b", "c", "RSquared"))
+			frames_[channel_] = frames_.get(channel_, 0) + 1
+	return dict((c_, f_) for c_, f_ in fits_.items() if frames_[c_] == nbSlice_)
+
+
+def getBleachModels(bleachMethodIdx_, meansDonor_, meansAcceptor_, impDonor_, impAcceptor_,
+		backROI_, imageDir_):
+	"""Simple Ratio (0) or Exponential Fit (1) models of the donor and acceptor.
+
+	meansDonor_ and meansAcceptor_ are the means of the raw frames. The
+	Simple Ratio background is measured in backROI_ on the first raw frame;
+	the exponential fits are saved in imageDir_ (and reused from there with
+	BLEACH_FIT_REUSE).
+	"""
+	if bleachMethodIdx_ == 0:
+		return (getSimpleRatioModel("donor", meansDonor_,
+				getMeanInROI(ImagePlus("Donor", impDonor_.getStack().getProcessor(1)), backROI_)),
+			getSimpleRatioModel("acceptor", meansAcceptor_,
+				getMeanInROI(ImagePlus("Acceptor", impAcceptor_.getStack().getProcessor(1)), backROI_)))
+	# Exponential Fit, in-process: no plot window, also in streaming mode
+	bleachFitPath_ = os.path.join(imageDir_, BLEACH_FIT_FILENAME)
+	savedFits_ = loadBleachFit(bleachFitPath_, len(meansDonor_)) if BLEACH_FIT_REUSE else {}
+	if savedFits_:
+		log_info("Bleaching fit parameters reused from " + BLEACH_FIT_FILENAME)
+	models_ = (getExponentialModel("donor", meansDonor_, savedFits_.get("donor")),
+		getExponentialModel("acceptor", meansAcceptor_, savedFits_.get("acceptor")))
+	saveBleachFit(models_, bleachFitPath_)
+	log_info("Saved bleaching fit: " + BLEACH_FIT_FILENAME)
+	return models_
+
+
+class HistogramMatcher(object):
+	"""Streaming "Histogram Matching" bleaching correction of one channel.
+
+	The cumulative histogram (CDF) of the reference frame, the first one,
+	is built once. match() then derives a lookup table from the histogram
+	of a frame and remaps a copy of this frame only, so no corrected stack
+	is kept. Only the valid values [1, maxVal_ - 1] are matched: null and
+	saturated pixels keep their value and are still masked afterwards.
+	It keeps no state once created (thread-safe). 8- and 16-bit stacks only.
+	"""
+
+	def __init__(self, channel_, stack_, maxVal_):
+		self.channel = channel_
+		self.maxVal = int(maxVal_)
+		self.reference = self.getCDF(stack_.getProcessor(1).getHistogram())
+
+	def getCDF(self, hist_):
+		"""Normalised cumulative histogram of the values 1 to maxVal - 1."""
+		cdf_ = [0.0] * self.maxVal
+		total_ = 0
+		for v_ in range(1, self.maxVal):
+			total_ += hist_[v_]
+			cdf_[v_] = total_
+		if total_ > 0:
+			cdf_ = [c_ / float(total_) for c_ in cdf_]
+		return cdf_
+
+	def getTable(self, hist_):
+		"""Lookup table mapping each value to the reference value of same rank."""
+		cdf_ = self.getCDF(hist_)
+		lut_ = range(len(hist_))
+		r_ = 1
+		for v_ in range(1, self.maxVal):
+			while r_ < self.maxVal - 1 and self.reference[r_] < cdf_[v_]:
+				r_ += 1
+			lut_[v_] = r_
+		return jarray.array(lut_, "i")
+
+	def match(self, ip_, slic_):
+		"""Return a copy of the raw frame slic_ (0-based) matched to the reference frame."""
+		ip_ = ip_.duplicate()
+		if slic_ > 0:
+			ip_.resetRoi()
+			ip_.applyTable(self.getTable(ip_.getHistogram()))
+		return ip_
+
+
+def despeckle32(ip_, radius_=DESPECKLE_RADIUS):
+	"""NaN-aware median filter of a 32-bit frame, in place.
+
+	This is the median of RankFilters, as used by the "Despeckle" command
+	(radius 1 = 3x3). NaN pixels are left out of the neighbourhood, and a
+	pixel becomes NaN only when its whole neighbourhood is NaN. RankFilters
+	already filters a frame on Prefs.getThreads() threads, so it is not
+	called from pooled tasks (see correctStack32).
+	A radius of 0 leaves the frame unchanged.
+	"""
+	if radius_ > 0:
+		ip_.resetRoi()
+		RankFilters().rank(ip_, radius_, RankFilters.MEDIAN)
+	return ip_
+
+
+def maskFrame32(ip_, minthres_, maxthres_, radius_=DESPECKLE_RADIUS):
+	"""Set the pixels of a 32-bit frame outside [minthres_, maxthres_] to NaN and despeckle it.
+
+	Works in place on the pixel array. With the default radius the result
+	is that of the "NaN Background" and "Despeckle" commands.
+	"""
+	background_ = getBackgroundMask(ip_, minthres_, maxthres_)
+	ip_.setValue(Float.NaN)
+	ip_.fill(background_)
+	return despeckle32(ip_, radius_)
+
+
+def allocateStack32(width_, height_, nbSlice_):
+	"""Create a 32-bit stack with all its planes allocated up front.
+
+	Fails before any frame is processed when the heap cannot hold it.
+	"""
+	sizeBytes_ = 4.0 * width_ * height_ * nbSlice_
+	if sizeBytes_ > IJ.maxMemory() - IJ.currentMemory():
+		System.gc()
+		if sizeBytes_ > IJ.maxMemory() - IJ.currentMemory():
+			raise Exception("Not enough memory for a %d-frame 32-bit stack (%.0f MB)"
+				% (nbSlice_, sizeBytes_ / 1048576.0))
+	return ImageStack.create(width_, height_, nbSlice_, 32)
+
+
+class MaskingSweep(VirtualStack):
+	"""Single, in-order read of a raw stack that masks every frame on the way.
+
+	getProcessor() reads a raw frame and returns it unchanged, after handing
+	it to a worker that records its mean (with means_), corrects it with
+	matcher_ (HistogramMatcher), then converts and masks it straight into its
+	plane of stackOut_. Used as the stack of the saved raw image, the TIFF
+	encoder drives the sweep, so that each plane of a virtual stack is read
+	once for the raw save, the bleaching means and the masking. At most
+	2 x Prefs.getThreads() frames wait for a worker.
+	"""
+
+	def __init__(self, stack_, stackOut_, minthres_, maxthres_, matcher_=None, means_=None):
+		VirtualStack.__init__(self, stack_.getWidth(), stack_.getHeight(), None, "")
+		self.source = stack_
+		self.stackOut = stackOut_
+		self.thresholds = (minthres_, maxthres_)
+		self.matcher = matcher_
+		self.means = means_
+		self.swept = [False] * stack_.getSize()
+		nThreads_ = max(1, min(Prefs.getThreads(), stack_.getSize()))
+		self.pool = Executors.newFixedThreadPool(nThreads_)
+		self.slots = Semaphore(2 * nThreads_)
+		self.futures = []
+
+	def getProcessor(self, n):
+		ip_ = self.source.getProcessor(n)
+		self.slots.acquire()
+		self.futures.append(self.pool.submit(PipelineTask("Masking of frame %d" % n,
+			self.maskFrame, ip_, n - 1)))
+		self.swept[n - 1] = True
+		return ip_
+
+	def getSize(self):
+		return self.source.getSize()
+
+	def getSliceLabel(self, n):
+		return self.source.getSliceLabel(n)
+
+	def maskFrame(self, ip_, n_):
+		"""Worker side of the sweep for the frame n_ (0-based)."""
+		try:
+			if self.means is not None:
+				self.means[n_] = ImageStatistics.getStatistics(ip_, Measurements.MEAN, None).mean
+			if self.matcher is not None:
+				ip_ = self.matcher.match(ip_, n_)
+			plane_ = FloatProcessor(self.stackOut.getWidth(), self.stackOut.getHeight(),
+				self.stackOut.getPixels(n_ + 1))
+			if isinstance(ip_, FloatProcessor):
+				System.arraycopy(ip_.getPixels(), 0, plane_.getPixels(), 0, plane_.getPixelCount())
+			else:
+				ip_.toFloat(0, plane_)
+			maskFrame32(plane_, self.thresholds[0], self.thresholds[1], 0)
+		finally:
+			self.slots.release()
+
+	def readRemaining(self):
+		"""Read the frames not read yet, e.g. when no raw image is saved."""
+		for n_ in range(len(self.swept)):
+			if not self.swept[n_]:
+				self.getProcessor(n_ + 1)
+
+	def finish(self):
+		"""Wait for the workers and return the number of frames that failed."""
+		self.pool.shutdown()
+		return len([f_ for f_ in self.futures if not f_.get()])
+
+
+def getSweepImage(imp_, sweep_):
+	"""Image of the raw stack imp_ served by sweep_, with the same dimensions and display."""
+	impRaw_ = ImagePlus(imp_.getTitle(), sweep_)
+	impRaw_.setDimensions(imp_.getNChannels(), imp_.getNSlices(), imp_.getNFrames())
+	impRaw_.setOpenAsHyperStack(imp_.isHyperStack())
+	impRaw_.setCalibration(imp_.getCalibration())
+	impRaw_.setLut(imp_.getProcessor().getLut())
+	impRaw_.setDisplayRange(imp_.getDisplayRangeMin(), imp_.getDisplayRangeMax())
+	return impRaw_
+
+
+def maskStack32(imp_, minthres_, maxthres_, matcher_=None, means_=None, rawPath_=None,
+		writer_=None):
+	"""Return all frames of imp_ as a new 32-bit stack masked by maskFrame32(), without despeckle.
+
+	The output stack is allocated in full from the number of frames, then
+	the raw frames are read once, in order, by a MaskingSweep, and converted
+	and masked straight into their planes on Prefs.getThreads() threads.
+	With matcher_ (HistogramMatcher) the frames are corrected before the
+	conversion; with means_ (array of one float per frame) the mean of each
+	raw frame is recorded for the bleaching models. With rawPath_, the raw
+	stack is saved there as TIFF by this sweep (errors are reported by
+	writer_.drain()). The despeckle and bleaching models are applied
+	afterwards by correctStack32. imp_ is unchanged.
+	"""
+	stack_ = imp_.getStack()
+	stackOut_ = allocateStack32(imp_.getWidth(), imp_.getHeight(), stack_.getSize())
+	sweep_ = MaskingSweep(stack_, stackOut_, minthres_, maxthres_, matcher_, means_)
+	try:
+		if rawPath_ is not None:
+			TiffWriteTask(writer_, getSweepImage(imp_, sweep_), rawPath_, 0).call()
+		sweep_.readRemaining()
+	finally:
+		nbFailed_ = sweep_.finish()
+	if nbFailed_ > 0:
+		raise Exception("Masking of saturated and null pixels failed: " + imp_.getTitle())
+	return stackOut_
+
+
+def correctStack32(stack_, bleachModel_=None):
+	"""Correct the photobleaching (BleachModel) and despeckle the planes of a masked stack, in place.
+
+	The frames are done one at a time, as RankFilters already runs on
+	several threads.
+	"""
+	for n_ in range(stack_.getSize()):
+		plane_ = stack_.getProcessor(n_ + 1)
+		if bleachModel_ is not None:
+			bleachModel_.correct(plane_, n_)
+		despeckle32(plane_)
+	return stack_
+
+
+class FrameReader(object):
+	"""32-bit access to the frames of a stack without per-frame allocation.
+
+	getFrame() converts a frame into a single float buffer owned by the
+	reader, always wrapped in the same ImagePlus. The previous frame is
+	overwritten, so a frame must be finished with before the next one is
+	read. The source stack is never modified. With matcher_
+	(HistogramMatcher), the frames are corrected before the conversion.
+	"""
+
+	def __init__(self, imp_, matcher_=None):
+		self.stack = imp_.getStack()
+		self.matcher = matcher_
+		self.buffer = FloatProcessor(imp_.getWidth(), imp_.getHeight())
+		self.imp = ImagePlus(imp_.getTitle(), self.buffer)
+		self.imp.setCalibration(imp_.getCalibration())
+
+	def getFrame(self, slic_):
+		"""Return the frame slic_ (1-based) as the reader's 32-bit image."""
+		ip_ = self.stack.getProcessor(slic_)
+		if self.matcher is not None:
+			ip_ = self.matcher.match(ip_, slic_ - 1)
+		if isinstance(ip_, FloatProcessor):
+			pixels_ = self.buffer.getPixels()
+			System.arraycopy(ip_.getPixels(), 0, pixels_, 0, len(pixels_))
+		else:
+			ip_.toFloat(0, self.buffer)
+		self.buffer.resetThreshold()
+		self.buffer.resetMinAndMax()
+		return self.imp
+
+
+def getFrameStats(ip_, cal_=None):
+	"""Histogram, min/max, mean, standard deviation and (calibrated) area of a frame, in one pass."""
+	return ImageStatistics.getStatistics(ip_, FRAME_STATS_MEASUREMENTS, cal_)
+
+
+class StackStatsCache(object):
+	"""Per-frame statistics of a stack, shared by all the steps that need them.
+
+	A frame is scanned once, the first time its statistics are asked for
+	(getFrameStats); later requests read the cached values. Frames modified
+	afterwards must be dropped with invalidate().
+	"""
+
+	def __init__(self, stack_, cal_=None):
+		self.stack = stack_
+		self.cal = cal_
+		self.frames = {}
+
+	def getStats(self, slic_):
+		"""Return the statistics of the frame slic_ (1-based)."""
+		stats_ = self.frames.get(slic_)
+		if stats_ is None:
+			stats_ = getFrameStats(self.stack.getProcessor(slic_), self.cal)
+			self.frames[slic_] = stats_
+		return stats_
+
+	def invalidate(self, slic_=None):
+		"""Drop the statistics of the frame slic_, or of all frames."""
+		if slic_ is None:
+			self.frames.clear()
+		else:
+			self.frames.pop(slic_, None)
+
+
+def getContrastRange(stats_, saturated_=CONTRAST_SATURATED):
+	"""Display range leaving saturated_ % of the pixels saturated ("Enhance Contrast")."""
+	histogram_ = stats_.histogram
+	nBins_ = len(histogram_)
+	limit_ = int(stats_.pixelCount * saturated_ / 200.0)
+	hmin_, count_ = 0, histogram_[0]
+	while count_ <= limit_ and hmin_ < nBins_ - 1:
+		hmin_ += 1
+		count_ += histogram_[hmin_]
+	hmax_, count_ = nBins_ - 1, histogram_[nBins_ - 1]
+	while count_ <= limit_ and hmax_ > 0:
+		hmax_ -= 1
+		count_ += histogram_[hmax_]
+	if hmax_ < hmin_:
+		return stats_.min, stats_.max
+	min_ = stats_.histMin + hmin_ * stats_.binSize
+	max_ = stats_.histMin + hmax_ * stats_.binSize
+	if min_ == max_:
+		return stats_.min, stats_.max
+	return min_, max_
+
+
+def getAutoThresholdRange(stats_, method_, dark_=True):
+	"""Threshold (min, max) given by an AutoThresholder method on the frame histogram."""
+	level_ = AutoThresholder().getThreshold(method_, stats_.histogram)
+	if dark_:
+		return stats_.histMin + (level_ + 1) * stats_.binSize, stats_.max
+	return stats_.min, stats_.histMin + level_ * stats_.binSize
+
+
+def getAutoThresholds(frameStats_, method_):
+	"""(min, max) threshold of every frame given by an AutoThresholder method.
+
+	Only the histograms of frameStats_ (one ImageStatistics per frame) are
+	used, so no pixel is read again whatever the number of methods tried.
+	"""
+	method_ = AutoThresholder.Method.valueOf(method_)
+	return [getAutoThresholdRange(stats_, method_) for stats_ in frameStats_]
+
+
+def saveAutoThresholdComparison(frameStats_, path_):
+	"""Write the lower threshold of every AutoThresholder method for all frames (CSV)."""
+	methods_ = list(AutoThresholder.getMethods())
+	thresholds_ = [getAutoThresholds(frameStats_, m_) for m_ in methods_]
+	with open(path_, "wb") as csvfile_:
+		writer_ = csv.writer(csvfile_)
+		writer_.writerow(["Frame #"] + methods_)
+		for slic_ in range(len(frameStats_)):
+			writer_.writerow([slic_ + 1] + [t_[slic_][0] for t_ in thresholds_])
+
+
+def addMeasurement(rt_, stats_):
+	"""Append the Area/Mean/StdDev of a frame to a results table, as Analyzer.measure()."""
+	rt_.incrementCounter()
+	rt_.addValue("Area", stats_.area)
+	rt_.addValue("Mean", stats_.mean)
+	rt_.addValue("StdDev", stats_.stdDev)
+
+
+def getSaturationValue(stats_, depth_):
+	"""Return the saturation value of the camera (2^depth - 1).
+
+	stats_ are the statistics of the first raw frame: 16-bit data that stay
+	below 4096 come from a 12-bit camera.
+	"""
+	if depth_ > 8:
+		maxPix_ = stats_.max
+		if maxPix_ < 4096 :
+			depth_ = 12 # the camera is 12-bits dynamical range =[0,4095]
+	return math.pow(2, depth_) - 1
+
+
+def askSameForAllFrames(title_, message_):
+	"""Ask whether the current choice applies to all the remaining frames."""
+	dial_ = YesNoCancelDialog(IJ.getInstance(), title_, message_,
+		"  Yes  ", "  No  ")
+	return dial_.yesPressed()
+
+
+def getThresholdInteractively(impT_, stats_):
+	"""Let the user adjust the threshold on impT_ and return (min, max).
+
+	stats_ are the statistics of the frame, which give the initial display
+	range and the "Moments dark" threshold proposed to the user.
+	"""
+	impT_.setDisplayRange(*getContrastRange(stats_))
+	impT_.show()
+	ta = ThresholdAdjuster()
+	ta.show()
+	ta.update()
+	lower_, upper_ = getAutoThresholdRange(stats_, AutoThresholder.Method.Moments)
+	impT_.getProcessor().setThreshold(lower_, upper_, ImageProcessor.RED_LUT)
+	impT_.updateAndDraw()
+	waitDialog = WaitForUserDialog("Manual threshold",
+		"Please, adjust the threshold as desired, then press 'OK' (do not press 'Apply')")
+	waitDialog.show()
+	thres_min_ = impT_.getProcessor().getMinThreshold()
+	thres_max_ = impT_.getProcessor().getMaxThreshold()
+	ta.close()
+	impT_.hide()
+	return thres_min_, thres_max_
+
+
+def collectFrameParameters(impDonor_, impAcceptor_, params_):
+	"""Ask once, on the first frame, for the background ROI and threshold values.
+
+	The answers are stored in params_ ("backROI", "thresholds") so that the
+	analysis can then run on all frames and series without any dialog. Values
+	already set (e.g. by a preset) are not asked again.
+	"""
+	impAcceptor_slice = FrameReader(impAcceptor_).getFrame(1)
+	maxVal_ = getSaturationValue(getFrameStats(impAcceptor_slice.getProcessor()),
+		impAcceptor_.getBitDepth())
+	maskFrame32(impAcceptor_slice.getProcessor(), 1, maxVal_ - 1)
+	if needsBackgroundROI(params_) and params_["backROI"] is None:
+		params_["backROI"] = getBackgroundROI(impAcceptor_slice)
+	if not params_["manualThreshold"] and params_["thresholds"] is None \
+			and params_["thresholdMethod"] == THRESHOLD_INTERACTIVE:
+		params_["thresholds"] = getThresholdInteractively(impAcceptor_slice.duplicate(),
+			getFrameStats(impAcceptor_slice.getProcessor()))
+		log_info("Threshold values: min = %.1f, max = %.1f" % params_["thresholds"])
+	impAcceptor_slice.close()
+	return params_
+
 	
+def processFrame(impDonor_, impAcceptor_, backROI_, thresholds_, params_, traceCells_=False,
+		ipFRET_=None, ballEstimators_=None, slic_=0):
+	"""Subtract the background of a donor/acceptor frame and set it to NaN, in place.
+
+	With ipFRET_, the frame goes through the fused kernel (fusedFrameKernel),
+	which also writes the FRET metric params_["FRETchoice"] into ipFRET_.
+	The rolling ball method is not supported by the kernel.
+
+	Parameters
+	----------
+	impDonor_, impAcceptor_ : ImagePlus
+		32-bit frames, already masked by maskFrame32.
+	backROI_ : Roi
+		Background ROI (method "ROI" of the background subtraction).
+	thresholds_ : tuple
+		(min, max) threshold of the cells in the acceptor frame.
+	params_ : dict
+		Analysis parameters (background method and values), not modified.
+	traceCells_ : bool
+		Also trace the cells as a selection.
+	ipFRET_ : FloatProcessor
+		Output plane of the FRET metric (fused kernel), or None.
+	ballEstimators_ : tuple
+		Donor and acceptor RollingBallEstimator of the approximate rolling
+		ball, or None for the exact "Subtract Background...".
+	slic_ : int
+		Index of the frame (0-based), for the rolling ball estimators.
+
+	Returns
+	-------
+	tuple
+		Background values of the donor and acceptor, and the cell selection
+		(None unless traceCells_).
+	"""
+	ChoiceSub_ = params_["ChoiceSub"]
+	BGValueDonor_ = params_["BGValueDonor"]
+	BGValueAcceptor_ = params_["BGValueAcceptor"]
+	thres_min_, thres_max_ = thresholds_
+
+	roiCells_ = None
+	if traceCells_:
+		roiCells_ = getCellROI(impAcceptor_, thres_min_, thres_max_)
+
+	if ipFRET_ is not None:
+		# The kernel masks the cells itself: the background mask is only
+		# built to measure the background in it
+		if ChoiceSub_ == BACKGROUND_SUBTRACTION_METHODS[1]:
+			BGValueDonor_ = getMeanInROI(impDonor_, backROI_)
+			BGValueAcceptor_ = getMeanInROI(impAcceptor_, backROI_)
+		elif ChoiceSub_ == BACKGROUND_SUBTRACTION_METHODS[2]:
+			maskNan_ = getBackgroundMask(impAcceptor_.getProcessor(), thres_min_, thres_max_)
+			BGValueDonor_ = getMeanInMask(impDonor_.getProcessor(), maskNan_)
+			BGValueAcceptor_ = getMeanInMask(impAcceptor_.getProcessor(), maskNan_)
+		fusedFrameKernel(impDonor_.getProcessor(), impAcceptor_.getProcessor(), ipFRET_,
+			(BGValueDonor_, BGValueAcceptor_), thresholds_, params_["FRETchoice"])
+		return BGValueDonor_, BGValueAcceptor_, roiCells_
+
+	# Pixels outside the threshold in the acceptor image = background
+	maskNan_ = getBackgroundMask(impAcceptor_.getProcessor(), thres_min_, thres_max_)
+	if ChoiceSub_ == BACKGROUND_SUBTRACTION_METHODS[0]:
+		impDonor_.getProcessor().subtract(BGValueDonor_)
+		impAcceptor_.getProcessor().subtract(BGValueAcceptor_)
+	elif ChoiceSub_ == BACKGROUND_SUBTRACTION_METHODS[1]:
+		BGValueDonor_ = subtractBG(impDonor_, backROI_)
+		BGValueAcceptor_ = subtractBG(impAcceptor_, backROI_)
+	elif ChoiceSub_ == BACKGROUND_SUBTRACTION_METHODS[2]:
+		BGValueDonor_ = subtractBGMask(impDonor_, maskNan_)
+		BGValueAcceptor_ = subtractBGMask(impAcceptor_, maskNan_)
+	elif ChoiceSub_ == BACKGROUND_SUBTRACTION_METHODS[3]:
+		rollingBall_ = params_["rollingBall"]
+		if ballEstimators_ is not None:
+			ballEstimators_[0].subtract(impDonor_.getProcessor(), slic_)
+			ballEstimators_[1].subtract(impAcceptor_.getProcessor(), slic_)
+		else:
+			IJ.run(impDonor_, "Subtract Background...", "rolling=" + str(rollingBall_) + " stack")
+			IJ.run(impAcceptor_, "Subtract Background...", "rolling=" + str(rollingBall_) + " stack")
+		BGValueDonor_ = rollingBall_
+		BGValueAcceptor_ = rollingBall_
+
+	# Convert the background in NaN values in all images
+	applyMask2NAN(impDonor_, maskNan_)
+	applyMask2NAN(impAcceptor_, maskNan_)
+	return BGValueDonor_, BGValueAcceptor_, roiCells_
+
+
+def processFrames_(stackDonor_, stackAcceptor_, stackFRET_, frames_, frameSettings_, params_,
+		traceCells_, ballEstimators_, results_):
+	"""Run processFrame() in place on the frames (0-based) of frames_ of two 32-bit stacks.
+
+	With stackFRET_, the fused kernel also writes the FRET planes into it.
+	"""
+	viewDonor_ = ImagePlus("Donor", stackDonor_.getProcessor(1))
+	viewAcceptor_ = ImagePlus("Acceptor", stackAcceptor_.getProcessor(1))
+	for slic_ in frames_:
+		ipFRET_ = None
+		if stackFRET_ is not None:
+			ipFRET_ = stackFRET_.getProcessor(slic_ + 1)
+		viewDonor_.getProcessor().setPixels(stackDonor_.getPixels(slic_ + 1))
+		viewAcceptor_.getProcessor().setPixels(stackAcceptor_.getPixels(slic_ + 1))
+		backROI_, thresholds_ = frameSettings_[slic_]
+		if backROI_ is not None:
+			backROI_ = backROI_.clone() # a ROI is bound to the image it is set on
+		results_[slic_] = processFrame(viewDonor_, viewAcceptor_, backROI_, thresholds_,
+			params_, traceCells_, ipFRET_, ballEstimators_, slic_)
+		stackDonor_.setPixels(viewDonor_.getProcessor().getPixels(), slic_ + 1)
+		stackAcceptor_.setPixels(viewAcceptor_.getProcessor().getPixels(), slic_ + 1)
+
+
+def processFramesParallel(stackDonor_, stackAcceptor_, stackFRET_, first_, frameSettings_, params_,
+		traceCells_=False, ballEstimators_=None):
+	"""Run processFrame() on the frames first_ to the end of two stacks, in parallel.
+
+	The frames are shared among Prefs.getThreads() threads. frameSettings_
+	gives the (backROI, thresholds) of every frame. The results are returned
+	in frame order (list indexed by frame, None before first_), so they do
+	not depend on the scheduling of the threads.
+	"""
+	nbSlice_ = stackDonor_.getSize()
+	nThreads_ = max(1, min(Prefs.getThreads(), nbSlice_ - first_))
+	results_ = [None] * nbSlice_
+	tasks_ = [PipelineTask("Frames %d-%d" % (first_ + 1, nbSlice_), processFrames_,
+		stackDonor_, stackAcceptor_, stackFRET_, range(first_ + i_, nbSlice_, nThreads_),
+		frameSettings_, params_, traceCells_, ballEstimators_, results_) for i_ in range(nThreads_)]
+	if runTasks(tasks_, nThreads_) > 0:
+		raise Exception("Background subtraction of frames %d-%d failed" % (first_ + 1, nbSlice_))
+	return results_
+
+
 #### PART 3 :  FRET metric computation functions
 
-def CalculationFRETmetric(impD_, impA_, FRETmetric_):
-    """Compute the selected FRET metric from donor and acceptor stacks.
+def isWithin_(x_, min_, max_):
+	"""ImgMath condition min_ <= x_ <= max_ (false for NaN)."""
+	return ImgMath.AND(ImgMath.OR(ImgMath.GT(x_, min_), ImgMath.EQ(x_, min_)),
+		ImgMath.OR(ImgMath.LT(x_, max_), ImgMath.EQ(x_, max_)))
 
-    Depending on the user choice, this function computes:
-      - FRET index = 100 × A / (A + D)
-      - FRET ratio A/D
-      - FRET ratio D/A
 
-    Zero-valued and saturated pixels are excluded to avoid infinities and
-    extreme ratios.
+def getFRETExpression(d_, a_, FRETmetric_):
+	"""ImgMath expression of a FRET metric from the donor and acceptor expressions.
 
-    Parameters
-    ----------
-    impD_ : ImagePlus
-        Donor image stack (32-bit).
-    impA_ : ImagePlus
-        Acceptor image stack (32-bit).
-    FRETmetric_ : str
-        Name of the FRET metric as selected in the UI.
+	Depending on the user choice, the metric is:
+	  - FRET index = 100 x A / (A + D)
+	  - FRET ratio A/D
+	  - FRET ratio D/A
+	It is NaN where the denominator is below 1 (zero-valued pixels) and where
+	the ratio is out of range (index: A / (A + D) outside [0, 1]).
+	"""
+	if FRETmetric_ == FRET_METRICS[0]:
+		num_, den_, max_, scale_ = a_, ImgMath.add(d_, a_), 1, 100
+	elif FRETmetric_ == FRET_METRICS[1]:
+		num_, den_, max_, scale_ = a_, d_, Float.MAX_VALUE, 1
+	else:
+		num_, den_, max_, scale_ = d_, a_, Float.MAX_VALUE, 1
+	ratio_ = ImgMath.let("ratio", ImgMath.div(num_, ImgMath.var("den")),
+		ImgMath.IF(isWithin_(ImgMath.var("ratio"), 0, max_),
+			ImgMath.mul(ImgMath.var("ratio"), scale_), Float.NaN))
+	return ImgMath.let("den", den_,
+		ImgMath.IF(isWithin_(ImgMath.var("den"), 1, Float.MAX_VALUE), ratio_, Float.NaN))
+
+
+def fusedFrameKernel(ipDonor_, ipAcceptor_, ipFRET_, backgrounds_, thresholds_, FRETmetric_):
+	"""Background subtraction, cell masking and FRET metric of a frame, in one pass.
+
+	The three planes are viewed as one image whose first axis is the output
+	(FRET, donor, acceptor), so a single compiled ImgMath loop visits every
+	pixel once and writes its three outputs one after the other. At each
+	pixel the FRET value is computed first, from the masked donor and
+	acceptor values (see maskFrame32), before these are overwritten in
+	place. The cells are the acceptor pixels within thresholds_; everything
+	else becomes NaN, as in the multi-pass path.
 
-    Returns
-    -------
-    ImagePlus
-        FRET image stack corresponding to the chosen metric.
-    """
-    if FRETmetric_ == FRET_METRICS[0]:
-        # 1) Compute (Donor + Acceptor) image (denominator)
-        impD_ = IC.run(impD_, impA_, "Add create 32-bit stack")
-        # Remove zero-valued pixels to avoid infinities
-        IJ.setRawThreshold(impD_, 1, Float.MAX_VALUE, None)
-        IJ.run(impD_, "NaN Background", "stack")
-        # 2) Compute Acceptor / (Donor + Acceptor)
-        impA_ = IC.run(impA_, impD_, "Divide create 32-bit stack")
-        IJ.setRawThreshold(impA_, 0, 1, None)
-        IJ.run(impA_, "NaN Background", "stack")
-        IJ.run(impA_, "Multiply...", "value=100 stack")
-        IJ.run(impA_, "Enhance Contrast", "saturated=0.35 stack")
-    elif FRETmetric_ == FRET_METRICS[1]:
-        # A/D ratio
-        impA_ = CalculationFRETratio(impD_, impA_)
-    else:
-        # D/A ratio
-        impA_ = CalculationFRETratio(impA_, impD_)
-    return impA_
-
-
-def CalculationFRETratio(imp1_, imp2_):
-    """Compute a FRET ratio image as imp2_ / imp1_.
-
-    Both images are thresholded to remove zero-valued pixels and extreme
-    values, then the ratio is computed and contrast enhanced.
+	Parameters
+	----------
+	ipDonor_, ipAcceptor_ : FloatProcessor
+		Masked donor and acceptor frames, modified in place.
+	ipFRET_ : FloatProcessor
+		Output plane of the FRET metric.
+	backgrounds_ : tuple
+		Background values subtracted from the donor and the acceptor.
+	thresholds_ : tuple
+		(min, max) threshold of the cells in the acceptor frame.
+	FRETmetric_ : str
+		Name of the FRET metric as selected in the UI.
+	"""
+	width_ = ipDonor_.getWidth()
+	height_ = ipDonor_.getHeight()
+	dims_ = jarray.array([width_, height_], "l")
+	imgDonor_ = ArrayImgs.floats(ipDonor_.getPixels(), dims_)
+	imgAcceptor_ = ArrayImgs.floats(ipAcceptor_.getPixels(), dims_)
+	imgFRET_ = ArrayImgs.floats(ipFRET_.getPixels(), dims_)
+	# (output, x, y) views: the inputs are repeated along the output axis
+	def perPixel_(img_):
+		return Views.moveAxis(Views.addDimension(img_, 0, 2), 2, 0)
+	output_ = ImgMath.img(Views.addDimension(Views.addDimension(
+		ArrayImgs.floats(jarray.array([0, 1, 2], "f"), 3), 0, width_ - 1), 0, height_ - 1))
+	cells_ = isWithin_(ImgMath.img(perPixel_(imgAcceptor_)), thresholds_[0], thresholds_[1])
+	donor_ = ImgMath.sub(ImgMath.img(perPixel_(imgDonor_)), backgrounds_[0])
+	acceptor_ = ImgMath.sub(ImgMath.img(perPixel_(imgAcceptor_)), backgrounds_[1])
+	ImgMath.compute(ImgMath.IF(cells_,
+		ImgMath.IF(ImgMath.EQ(output_, 0), getFRETExpression(donor_, acceptor_, FRETmetric_),
+			ImgMath.IF(ImgMath.EQ(output_, 1), donor_, acceptor_)),
+		Float.NaN)).into(Views.moveAxis(Views.stack(imgFRET_, imgDonor_, imgAcceptor_), 2, 0))
+	ipFRET_.resetMinAndMax()
+
+
+def computeFRETPlane(ipDonor_, ipAcceptor_, ipFRET_, FRETmetric_):
+	"""Write the FRET metric of a donor/acceptor frame into ipFRET_, in one pass.
+
+	The computation is pixel-wise, so ipFRET_ may be ipDonor_ or ipAcceptor_
+	(in place). No other plane is allocated.
+	"""
+	dims_ = jarray.array([ipDonor_.getWidth(), ipDonor_.getHeight()], "l")
+	imgDonor_ = ArrayImgs.floats(ipDonor_.getPixels(), dims_)
+	imgAcceptor_ = ArrayImgs.floats(ipAcceptor_.getPixels(), dims_)
+	imgFRET_ = ArrayImgs.floats(ipFRET_.getPixels(), dims_)
+	ImgMath.compute(getFRETExpression(ImgMath.img(imgDonor_), ImgMath.img(imgAcceptor_),
+		FRETmetric_)).into(imgFRET_)
+	ipFRET_.resetMinAndMax()
 
-    Parameters
-    ----------
-    imp1_ : ImagePlus
-        Denominator image (e.g., donor or acceptor).
-    imp2_ : ImagePlus
-        Numerator image (e.g., acceptor or donor).
 
-    Returns
-    -------
-    ImagePlus
-        Ratio image (32-bit) with invalid pixels set to NaN.
-    """
-    # Remove zero-valued pixels in denominator
-    IJ.setRawThreshold(imp1_, 1, Float.MAX_VALUE, None)
-    IJ.run(imp1_, "NaN Background", "stack")
-    # Compute ratio imp2_ / imp1_
-    impRatio_ = IC.run(imp2_, imp1_, "Divide create 32-bit stack")
-    # Remove extreme ratio values created by division
-    IJ.setRawThreshold(impRatio_, 0, Float.MAX_VALUE, None)
-    IJ.run(impRatio_, "NaN Background", "stack")
-    IJ.run(impRatio_, "Enhance Contrast", "saturated=0.35 stack")
-    return impRatio_
+def computeFRETPlanes_(stackDonor_, stackAcceptor_, stacksFRET_, frames_, FRETmetrics_):
+	"""Run computeFRETPlane() for every metric on the frames (0-based) of frames_ of the stacks.
+
+	All the metrics of a frame are computed while its donor/acceptor planes
+	are read, before the next frame.
+	"""
+	for slic_ in frames_:
+		ipDonor_ = stackDonor_.getProcessor(slic_ + 1)
+		ipAcceptor_ = stackAcceptor_.getProcessor(slic_ + 1)
+		for FRETmetric_, stackFRET_ in zip(FRETmetrics_, stacksFRET_):
+			computeFRETPlane(ipDonor_, ipAcceptor_, stackFRET_.getProcessor(slic_ + 1), FRETmetric_)
+
+
+def CalculationFRETmetrics(impD_, impA_, FRETmetrics_, stacksFRET_=None):
+	"""Compute the selected FRET metrics from donor and acceptor stacks, in one pass.
+
+	Each plane is computed by computeFRETPlane() straight into the output
+	stack of its metric, so no intermediate (A+D) or ratio stack is created.
+	The frames are shared among Prefs.getThreads() threads.
+
+	Parameters
+	----------
+	impD_ : ImagePlus
+		Donor image stack (32-bit), not modified.
+	impA_ : ImagePlus
+		Acceptor image stack (32-bit), not modified.
+	FRETmetrics_ : list of str
+		Names of the FRET metrics as in the UI (FRET_METRICS).
+	stacksFRET_ : list of ImageStack
+		Output stack of each metric, allocated if None. For a single metric,
+		the stack of impD_ or impA_ may be given to compute it in place.
+
+	Returns
+	-------
+	list of ImagePlus
+		FRET image stack of each metric, in the order of FRETmetrics_.
+	"""
+	stackD_ = impD_.getStack()
+	stackA_ = impA_.getStack()
+	nbSlice_ = stackD_.getSize()
+	if stacksFRET_ is None:
+		stacksFRET_ = [allocateStack32(stackD_.getWidth(), stackD_.getHeight(), nbSlice_)
+			for FRETmetric_ in FRETmetrics_]
+	nThreads_ = max(1, min(Prefs.getThreads(), nbSlice_))
+	tasks_ = [PipelineTask("FRET metrics", computeFRETPlanes_, stackD_, stackA_, stacksFRET_,
+		range(i_, nbSlice_, nThreads_), FRETmetrics_) for i_ in range(nThreads_)]
+	if runTasks(tasks_, nThreads_) > 0:
+		raise Exception("Computation of the FRET metrics failed")
+	return [ImagePlus("FRET", stackFRET_) for stackFRET_ in stacksFRET_]
+
+
+def getMetricName(FRETmetric_):
+	"""Short name of a FRET metric used in the output file names."""
+	if FRETmetric_ == FRET_METRICS[0]:
+		return "index"
+	elif FRETmetric_ == FRET_METRICS[1]:
+		return "ratioA_D"
+	return "ratioD_A"
+
+
+def getFRETMetricIndex(metric_):
+	"""Index in FRET_METRICS of a metric given by index or by name (None if unknown).
+
+	Names are compared without their surrounding spaces, so that parameter
+	sets do not depend on the padding of the dialog choices.
+	"""
+	if hasattr(metric_, "strip"):
+		names_ = [m_.strip() for m_ in FRET_METRICS]
+		name_ = metric_.strip()
+		return names_.index(name_) if name_ in names_ else None
+	return int(metric_) if 0 <= metric_ < len(FRET_METRICS) else None
+
+
+def getFRETMetrics(FRETchoice_, extraMetrics_=()):
+	"""FRETchoice_ followed by the extra metrics computed in the same run.
+
+	Both are given by index or name (params_["FRETchoice"] and
+	params_["extraFRETMetrics"]); the metrics are returned as FRET_METRICS
+	entries, the unknown extra ones being left out.
+	"""
+	choice_ = getFRETMetricIndex(FRETchoice_)
+	extras_ = set(getFRETMetricIndex(m_) for m_ in extraMetrics_)
+	return [FRET_METRICS[choice_]] + [m_ for i_, m_ in enumerate(FRET_METRICS)
+		if i_ in extras_ and i_ != choice_]
+
+
+def getFRETRange(min_, max_, FRETmetric_):
+	"""Display and calibration bar range of a FRET stack from its min/max over all frames.
+
+	Stack and streaming modes both use the min/max of all the frames with
+	cells; the range of the FRET index is rounded to integers.
+	"""
+	if FRETmetric_ == FRET_METRICS[0] and min_ <= max_:
+		return math.floor(min_), math.ceil(max_)
+	return min_, max_
+
+
+def getMetricOutputNames(FRETmetric_, FRETchoice_, basename_):
+	"""Names of the FRET stack, measurement file and calibration bar of a metric.
+
+	The metric chosen in the dialog keeps the usual file names; the extra
+	metrics get their short name appended.
+	"""
+	name_ = getMetricName(FRETmetric_)
+	title_ = "FRET_" + name_ + "_" + os.path.basename(basename_)
+	if FRETmetric_ == FRETchoice_:
+		return title_, "MeanFRETindex.csv", "FRET_CalibrationBar"
+	return title_, "MeanFRET_" + name_ + ".csv", "FRET_CalibrationBar_" + name_
 
 
 def drawCalibrationBar(statsMin_, statsMax_):
@@ -537,6 +1986,996 @@ def drawCalibrationBar(statsMin_, statsMax_):
     return impBar_
 
 
+#### Output writing
+
+class TiffWriteTask(Callable):
+	"""Write one image as TIFF on the writer thread and release its queue quota."""
+
+	def __init__(self, writer_, imp_, path_, costMB_):
+		self.writer = writer_
+		self.imp = imp_
+		self.path = path_
+		self.costMB = costMB_
+
+	def call(self):
+		try:
+			saver_ = FileSaver(self.imp)
+			if self.imp.getStackSize() > 1:
+				ok_ = saver_.saveAsTiffStack(self.path)
+			else:
+				ok_ = saver_.saveAsTiff(self.path)
+			if not ok_:
+				self.writer.errors.append("%s: write failed" % self.path)
+		except (Exception, Throwable), e:
+			self.writer.errors.append("%s: %s" % (self.path, e))
+		finally:
+			self.writer.quota.release(self.costMB)
+		return self.path
+
+
+def getChunkedPath(path_):
+	"""Path of the chunked container that replaces the TIFF file path_."""
+	return os.path.splitext(path_)[0] + "." + CHUNKED_OUTPUT_FORMAT
+
+
+def openChunkedContainer(path_):
+	"""Create an empty N5 or Zarr container at path_ (an older one is removed)."""
+	if os.path.isdir(path_):
+		shutil.rmtree(path_)
+	if CHUNKED_OUTPUT_FORMAT == "zarr":
+		return N5ZarrWriter(path_)
+	return N5FSWriter(path_)
+
+
+def getChunkSize(nbDims_):
+	"""Chunk shape: one XY tile of a single frame."""
+	return jarray.array([CHUNK_SIZE_XY, CHUNK_SIZE_XY] + [1] * (nbDims_ - 2), "i")
+
+
+def writeChunkedCalibration(n5_, cal_, nbDims_):
+	"""Store the calibration with the dataset.
+
+	N5 gets the "resolution"/"pixelResolution" attributes read by the N5
+	viewer, Zarr gets the OME-NGFF "multiscales" metadata (axes t, y, x).
+	"""
+	scale_ = [cal_.pixelWidth, cal_.pixelHeight]
+	if nbDims_ > 2:
+		scale_.append(cal_.frameInterval if cal_.frameInterval > 0 else 1.0)
+	n5_.setAttribute(CHUNKED_DATASET, "resolution", jarray.array(scale_, "d"))
+	n5_.setAttribute(CHUNKED_DATASET, "pixelResolution", JsonParser().parse(
+		json.dumps({"dimensions": scale_, "unit": cal_.getUnit()})))
+	if CHUNKED_OUTPUT_FORMAT != "zarr":
+		return
+	axes_ = []
+	for name_ in ("x", "y"):
+		axis_ = {"name": name_, "type": "space"}
+		if cal_.getUnit() in NGFF_UNITS:
+			axis_["unit"] = NGFF_UNITS[cal_.getUnit()]
+		axes_.append(axis_)
+	if nbDims_ > 2:
+		axis_ = {"name": "t", "type": "time"}
+		if cal_.getTimeUnit() in NGFF_UNITS:
+			axis_["unit"] = NGFF_UNITS[cal_.getTimeUnit()]
+		axes_.append(axis_)
+	# Zarr arrays are stored in C order: t, y, x
+	axes_.reverse()
+	scale_.reverse()
+	multiscales_ = [{"version": "0.4", "axes": axes_, "datasets": [{"path": CHUNKED_DATASET,
+		"coordinateTransformations": [{"type": "scale", "scale": scale_}]}]}]
+	n5_.setAttribute("/", "multiscales", JsonParser().parse(json.dumps(multiscales_)))
+
+
+def writeChunkedStack(imp_, path_, executor_):
+	"""Write a 32-bit image as a chunked container, chunks in parallel on executor_."""
+	img_ = ImageJFunctions.wrapFloat(imp_)
+	n5_ = openChunkedContainer(path_)
+	N5Utils.save(img_, n5_, CHUNKED_DATASET, getChunkSize(img_.numDimensions()),
+		GzipCompression(CHUNK_COMPRESSION_LEVEL), executor_)
+	writeChunkedCalibration(n5_, imp_.getCalibration(), img_.numDimensions())
+	n5_.close()
+
+
+class ChunkedWriteTask(TiffWriteTask):
+	"""Write one image as N5/Zarr container on the writer thread."""
+
+	def call(self):
+		try:
+			writeChunkedStack(self.imp, self.path, self.writer.getChunkExecutor())
+		except (Exception, Throwable), e:
+			self.writer.errors.append("%s: %s" % (self.path, e))
+		finally:
+			self.writer.quota.release(self.costMB)
+		return self.path
+
+
+class AsyncTiffWriter(object):
+	"""Write-behind queue for the TIFF outputs of the pipeline.
+
+	Finished images are handed to a single background thread and written
+	while the next stage runs. The images waiting in the queue are limited
+	to maxPendingMB_: submit() blocks once the limit is reached. Submitted
+	images must not be modified afterwards. Errors are collected and
+	reported in the log by drain(), which is called once at the very end.
+	Result stacks submitted with chunked_=True follow CHUNKED_OUTPUT_FORMAT.
+	"""
+
+	def __init__(self, maxPendingMB_):
+		self.maxPendingMB = max(1, int(maxPendingMB_))
+		self.quota = Semaphore(self.maxPendingMB)
+		self.executor = Executors.newSingleThreadExecutor()
+		self.chunkExecutor = None
+		self.futures = {}
+		self.errors = []
+
+	def getChunkExecutor(self):
+		"""Thread pool shared by the chunked writes (created on first use)."""
+		if self.chunkExecutor is None:
+			self.chunkExecutor = Executors.newFixedThreadPool(max(1, Prefs.getThreads()))
+		return self.chunkExecutor
+
+	def submit(self, imp_, path_, chunked_=False):
+		"""Queue imp_ to be written as TIFF at path_ (".tif" is added if missing).
+
+		With chunked_=True and a chunked CHUNKED_OUTPUT_FORMAT, the image is
+		written to getChunkedPath(path_) instead; waitFor() still takes path_.
+		"""
+		if not path_.lower().endswith((".tif", ".tiff")):
+			path_ += ".tif"
+		stack_ = imp_.getStack()
+		nPlanes_ = 1 if stack_.isVirtual() else imp_.getStackSize()
+		sizeMB_ = imp_.getWidth() * imp_.getHeight() * (imp_.getBitDepth() / 8) * nPlanes_ / 1048576.0
+		costMB_ = min(self.maxPendingMB, max(1, int(math.ceil(sizeMB_))))
+		self.quota.acquire(costMB_)
+		if chunked_ and CHUNKED_OUTPUT_FORMAT != "tiff":
+			task_ = ChunkedWriteTask(self, imp_, getChunkedPath(path_), costMB_)
+		else:
+			task_ = TiffWriteTask(self, imp_, path_, costMB_)
+		future_ = self.executor.submit(task_)
+		self.futures[path_] = future_
+		return future_
+
+	def waitFor(self, path_):
+		"""Block until the queued write of path_ is done."""
+		if not path_.lower().endswith((".tif", ".tiff")):
+			path_ += ".tif"
+		future_ = self.futures.get(path_)
+		if future_ is not None:
+			future_.get()
+
+	def drain(self):
+		"""Wait for all queued writes and report the failures in the log.
+
+		Returns True when every image was written.
+		"""
+		self.executor.shutdown()
+		self.executor.awaitTermination(Long.MAX_VALUE, TimeUnit.SECONDS)
+		if self.chunkExecutor is not None:
+			self.chunkExecutor.shutdown()
+		for error_ in self.errors:
+			log_error("Could not save " + error_)
+		return len(self.errors) == 0
+
+
+class StreamingStackWriter(object):
+	"""Append 32-bit planes one at a time to an OME-TIFF file.
+
+	Used by the streaming mode: a plane is written as soon as its frame is
+	processed, and the calibration of the stack is kept in the OME metadata.
+	"""
+
+	def __init__(self, path_, width_, height_, nbPlanes_, cal_):
+		meta_ = MetadataTools.createOMEXMLMetadata()
+		MetadataTools.populateMetadata(meta_, 0, os.path.basename(path_), False, "XYZCT",
+			FormatTools.getPixelTypeString(FormatTools.FLOAT), width_, height_, 1, 1, nbPlanes_, 1)
+		if cal_.scaled():
+			meta_.setPixelsPhysicalSizeX(FormatTools.getPhysicalSizeX(cal_.pixelWidth), 0)
+			meta_.setPixelsPhysicalSizeY(FormatTools.getPhysicalSizeY(cal_.pixelHeight), 0)
+		self.path = path_
+		self.writer = OMETiffWriter()
+		self.writer.setMetadataRetrieve(meta_)
+		self.writer.setBigTiff(4.0 * width_ * height_ * nbPlanes_ > 2.0e9)
+		if os.path.exists(path_):
+			os.remove(path_)
+		self.writer.setId(path_)
+		self.index = 0
+
+	def append(self, ip_):
+		"""Write the next plane (FloatProcessor)."""
+		self.writer.saveBytes(self.index, DataTools.floatsToBytes(ip_.getPixels(), False))
+		self.index += 1
+
+	def close(self):
+		self.writer.close()
+
+
+class ChunkedStreamingWriter(object):
+	"""Append 32-bit planes one at a time to an N5/Zarr container.
+
+	Streaming counterpart of writeChunkedStack(): the dataset is created for
+	all the frames up front and each plane is written as its own chunks.
+	"""
+
+	def __init__(self, path_, width_, height_, nbPlanes_, cal_):
+		self.path = path_
+		self.n5 = openChunkedContainer(path_)
+		self.n5.createDataset(CHUNKED_DATASET, jarray.array([width_, height_, nbPlanes_], "l"),
+			getChunkSize(3), DataType.FLOAT32, GzipCompression(CHUNK_COMPRESSION_LEVEL))
+		writeChunkedCalibration(self.n5, cal_, 3)
+		self.index = 0
+
+	def append(self, ip_):
+		"""Write the next plane (FloatProcessor)."""
+		plane_ = Views.addDimension(ImageJFunctions.wrapFloat(ImagePlus("", ip_)), 0, 0)
+		N5Utils.saveBlock(plane_, self.n5, CHUNKED_DATASET, jarray.array([0, 0, self.index], "l"))
+		self.index += 1
+
+	def close(self):
+		self.n5.close()
+
+
+def openStreamingWriter(path_, width_, height_, nbPlanes_, cal_):
+	"""Streaming writer for a result stack, in the CHUNKED_OUTPUT_FORMAT format."""
+	if CHUNKED_OUTPUT_FORMAT == "tiff":
+		return StreamingStackWriter(path_ + STREAM_EXTENSION, width_, height_, nbPlanes_, cal_)
+	return ChunkedStreamingWriter(getChunkedPath(path_ + ".tif"), width_, height_, nbPlanes_, cal_)
+
+
+def appendMeasurement(csvfile_, rt_, row_):
+	"""Append one row of the results table to an open measurement CSV file."""
+	csvfile_.write(",".join([IJ.d2s(rt_.getValue(col_, row_), 5)
+		for col_ in MEASUREMENT_COLUMNS]) + "\n")
+	csvfile_.flush()
+
+
+#### Pipeline drivers
+
+def getAnalysisParameters():
+	"""Gather the analysis parameters of the script dialog in a dictionary.
+
+	"backROI" and "thresholds" are filled on the first frame (interactively
+	or by collectFrameParameters); when set, no dialog is shown for them.
+	A preset may also hold one value per frame in "frameBackROIs" and
+	"frameThresholds" when they were chosen frame by frame.
+	"""
+	return {
+		"bleachCorr": bleachCorr,
+		"CorrectionMethod": CorrectionMethod,
+		"ChoiceSub": ChoiceSub,
+		"BGValueDonor": BGValueDonor,
+		"BGValueAcceptor": BGValueAcceptor,
+		"rollingBall": rollingBall,
+		"manualThreshold": manualThreshold,
+		"thresholdValue": thresholdValue,
+		"thresholdMethod": thresholdMethod,
+		"FRETchoice": FRETchoice,
+		"extraFRETMetrics": list(EXTRA_FRET_METRICS),
+		"calibrationBar": calibrationBar,
+		"backROI": None,
+		"thresholds": None
+	}
+
+
+def runAnalysis(impDonor, impAcceptor, imageDir, basename, params_, writer_, display_=True,
+		saveRaw_=False):
+	"""Run PART 2 and PART 3 of the pipeline on one donor/acceptor pair.
+
+	Parameters
+	----------
+	impDonor : ImagePlus
+		Raw donor stack.
+	impAcceptor : ImagePlus
+		Raw acceptor stack.
+	imageDir : str
+		Output folder of the dataset.
+	basename : str
+		Prefix of the output files.
+	params_ : dict
+		Analysis parameters (see getAnalysisParameters).
+	writer_ : AsyncTiffWriter
+		Output queue for the saved stacks.
+	display_ : bool
+		Show the FRET stack, the results table and the calibration bar.
+	saveRaw_ : bool
+		Also save the raw stacks ("_c1.tif", "_c2.tif"), once their display
+		range is set. Virtual stacks are saved by the masking sweep (stack
+		mode), other ones are queued on writer_.
+	"""
+	## Calibration and stack properties
+
+	cal = impAcceptor.getCalibration()
+	unit = cal.getUnit()
+	if unit =="micron" :
+		unit ="um"
+	pix2phys = cal.getX(1)
+
+
+	# Get width, height, frame, bit depth
+	nbSlice = impAcceptor.getStackSize()
+	width = impAcceptor.width
+	height = impAcceptor.height
+	depth = impAcceptor.getBitDepth()
+	log_info("Stack size: %d slices, width=%d, height=%d, bit-depth=%d"
+		% (nbSlice, width, height, depth))
+
+
+	# Statistics of the displayed and first raw frames, each scanned at most
+	# once (the bleaching models only keep the frame means, getFrameMeans)
+	statsDonorRaw = StackStatsCache(impDonor.getStack())
+	statsAcceptorRaw = StackStatsCache(impAcceptor.getStack())
+	impDonor.setDisplayRange(*getContrastRange(statsDonorRaw.getStats(impDonor.getCurrentSlice())))
+	impAcceptor.setDisplayRange(*getContrastRange(statsAcceptorRaw.getStats(impAcceptor.getCurrentSlice())))
+	# Raw virtual stacks are saved by the masking sweep of PART 2, which reads
+	# each plane once for the save, the bleaching means and the masking.
+	# Otherwise they are queued now: in memory they need no read, and in
+	# streaming mode the writer thread reads every plane once more
+	rawPaths = (None, None)
+	if saveRaw_ and not STREAMING_MODE and impDonor.getStack().isVirtual():
+		rawPaths = (os.path.join(imageDir, basename + "_c1.tif"),
+			os.path.join(imageDir, basename + "_c2.tif"))
+	elif saveRaw_:
+		# Submitted images must not be modified afterwards
+		writer_.submit(impDonor, os.path.join(imageDir, basename+"_c1.tif"))
+		writer_.submit(impAcceptor, os.path.join(imageDir, basename+"_c2.tif"))
+		log_info("Queued raw donor and acceptor images for saving: %s" % basename)
+
+
+	#### PART 2 :  Bleaching correction and substract background
+	log_step("PART 2 : Bleaching correction and background subtraction - " + basename)
+
+	ChoiceSub = params_["ChoiceSub"]
+	rollingBall = params_["rollingBall"]
+	backROI = params_["backROI"]
+	doBleachROI = backROI is None
+	# Automatic threshold: one AutoThresholder method on every frame histogram.
+	# It takes priority over threshold values recorded in a preset
+	thresholdMethod = params_.get("thresholdMethod", THRESHOLD_INTERACTIVE)
+	useAutoThreshold = thresholdMethod != THRESHOLD_INTERACTIVE \
+		and not params_["manualThreshold"]
+	doThreshold = useAutoThreshold or params_["thresholds"] is None
+	if not doThreshold:
+		thres_min, thres_max = params_["thresholds"]
+	# Frame-by-frame choices replayed from a preset of the same movie
+	frameBackROIs = params_.get("frameBackROIs")
+	frameThresholds = None if useAutoThreshold else params_.get("frameThresholds")
+	if frameBackROIs is not None and len(frameBackROIs) != nbSlice:
+		log_warning("Preset background ROIs ignored: recorded for another number of frames")
+		frameBackROIs = None
+	if frameThresholds is not None and len(frameThresholds) != nbSlice:
+		log_warning("Preset threshold values ignored: recorded for another number of frames")
+		frameThresholds = None
+	if params_["manualThreshold"]:
+		thresholdSource = "Manual"
+	elif useAutoThreshold:
+		thresholdSource = thresholdMethod
+		log_info("Automatic threshold of all frames by the %s method" % thresholdMethod)
+	else:
+		thresholdSource = "Interactive"
+	autoThresholdStats = []
+	usedBackROIs = []
+	usedThresholds = []
+	# Background/Threshold CSV File, one row appended per frame
+	infoFile = open(os.path.join(imageDir, "infoFile.csv"), "wb")
+	infoWriter = csv.DictWriter(infoFile, fieldnames=CSV_FIELDNAMES)
+	infoWriter.writeheader()
+	# Vector outlines of the cells, only traced when asked for
+	cellROIs = [] if SAVE_CELL_ROIS else None
+
+	FRETmetrics = getFRETMetrics(params_["FRETchoice"], params_["extraFRETMetrics"])
+	FRETchoice = FRETmetrics[0]
+	FRETOutputs = [getMetricOutputNames(m, FRETchoice, basename) for m in FRETmetrics]
+	FRETTitle = FRETOutputs[0][0]
+	if len(FRETmetrics) > 1:
+		log_info("FRET metrics of this run: " + ", ".join(m.strip() for m in FRETmetrics))
+	rts = [ResultsTable() for m in FRETmetrics]
+	if STREAMING_MODE:
+		# PART 3 runs inside the frame loop: planes and measurements are
+		# appended to the output files as soon as each frame is done
+		log_info("Streaming mode: frames are measured and saved one at a time (stacks as %s)"
+			% STREAM_EXTENSION)
+		streamDonor = openStreamingWriter(os.path.join(imageDir, basename + "_c1thres"),
+			width, height, nbSlice, cal)
+		streamAcceptor = openStreamingWriter(os.path.join(imageDir, basename + "_c2thres"),
+			width, height, nbSlice, cal)
+		streamsFRET = []
+		measureFiles = []
+		for titleFRET, measureName, barName in FRETOutputs:
+			streamsFRET.append(openStreamingWriter(os.path.join(imageDir, titleFRET),
+				width, height, nbSlice, cal))
+			measureFile = open(os.path.join(imageDir, measureName), "wb")
+			measureFile.write(",".join(MEASUREMENT_COLUMNS) + "\n")
+			measureFiles.append(measureFile)
+		statsMins = [Float.MAX_VALUE] * len(FRETmetrics)
+		statsMaxs = [-Float.MAX_VALUE] * len(FRETmetrics)
+
+	#Check the bit depth of the images and remove saturated and null pixels (saturated pixel are above  2^depth )
+	maxVal = getSaturationValue(statsAcceptorRaw.getStats(1), depth)
+	# Photobleaching correction: fitted once per channel on the whole
+	# timelapse from the frame means, then applied to the masked frames
+	bleachMethodIdx = None
+	bleachModels = (None, None)
+	bleachMatchers = (None, None)
+	if params_["bleachCorr"]:
+		if nbSlice > 1:
+			bleachMethodIdx = CORRECTION_METHODS.index(params_["CorrectionMethod"])
+			log_info("Correction of the photobleaching (%s)" % params_["CorrectionMethod"])
+		else:
+			log_info("No photobleaching correction because raw data is not a stack")
+	if bleachMethodIdx == 0:
+		# Simple Ratio: the background is measured in the ROI of the first frame
+		if backROI is None and frameBackROIs is not None:
+			backROI = frameBackROIs[0]
+		elif backROI is None:
+			impROI = FrameReader(impAcceptor).getFrame(1)
+			maskFrame32(impROI.getProcessor(), 1, maxVal - 1)
+			backROI = getBackgroundROI(impROI)
+	elif bleachMethodIdx == 2 and depth == 32:
+		log_warning("Histogram Matching needs 8- or 16-bit images: no bleaching correction")
+	elif bleachMethodIdx == 2:
+		# Histogram Matching: lookup table per frame, to the CDF of the first frame
+		bleachMatchers = (HistogramMatcher("donor", impDonor.getStack(), maxVal),
+			HistogramMatcher("acceptor", impAcceptor.getStack(), maxVal))
+	# Simple Ratio and Exponential Fit need the mean of every raw frame:
+	# measured by the masking sweep, or by one more read of the raw stacks
+	# in streaming mode, where the first frame is corrected before the others are read
+	needMeans = bleachMethodIdx in (0, 1)
+	if STREAMING_MODE and needMeans:
+		bleachModels = getBleachModels(bleachMethodIdx, getFrameMeans(impDonor.getStack()),
+			getFrameMeans(impAcceptor.getStack()), impDonor, impAcceptor, backROI, imageDir)
+	# Fused kernel: the FRET planes are computed with the frames in PART 2
+	useFusedKernel = USE_FUSED_KERNEL and ChoiceSub != BACKGROUND_SUBTRACTION_METHODS[3]
+	if STREAMING_MODE:
+		# One reusable 32-bit buffer per channel
+		readerDonor = FrameReader(impDonor, bleachMatchers[0])
+		readerAcceptor = FrameReader(impAcceptor, bleachMatchers[1])
+		# and per FRET metric
+		buffersFRET = [FloatProcessor(width, height) for m in FRETmetrics]
+	else:
+		# All frames at once: one in-order read of the raw frames, converted and
+		# masked in parallel into the preallocated output stacks, then bleaching
+		# correction and despeckle. The frames are then processed in place
+		# through one view per channel
+		meansDonor = jarray.zeros(nbSlice, "d") if needMeans else None
+		meansAcceptor = jarray.zeros(nbSlice, "d") if needMeans else None
+		stackDonor = maskStack32(impDonor, 1, maxVal - 1, bleachMatchers[0], meansDonor,
+			rawPaths[0], writer_)
+		stackAcceptor = maskStack32(impAcceptor, 1, maxVal - 1, bleachMatchers[1], meansAcceptor,
+			rawPaths[1], writer_)
+		if rawPaths[0] is not None:
+			log_info("Saved raw donor and acceptor images: %s" % basename)
+		if needMeans:
+			bleachModels = getBleachModels(bleachMethodIdx, list(meansDonor), list(meansAcceptor),
+				impDonor, impAcceptor, backROI, imageDir)
+		correctStack32(stackDonor, bleachModels[0])
+		correctStack32(stackAcceptor, bleachModels[1])
+		viewDonor = ImagePlus(impDonor.getTitle(), stackDonor.getProcessor(1))
+		viewAcceptor = ImagePlus(impAcceptor.getTitle(), stackAcceptor.getProcessor(1))
+		stackFRET = allocateStack32(width, height, nbSlice) if useFusedKernel else None
+		statsAcceptor = StackStatsCache(stackAcceptor)
+		if useAutoThreshold:
+			# All the thresholds are known before the loop, so that the frames
+			# can be processed in parallel
+			autoThresholdStats = [statsAcceptor.getStats(slicA + 1) for slicA in range(nbSlice)]
+			frameThresholds = getAutoThresholds(autoThresholdStats, thresholdMethod)
+
+	def recordFrame(slic_, backROI_, thresholds_, result_):
+		"""Log the background/threshold values of a processed frame."""
+		BGValueDonor_, BGValueAcceptor_, roiCells_ = result_
+		if ChoiceSub in BACKGROUND_SUBTRACTION_METHODS[1:3]:
+			log_info("Background donor = %.1f, acceptor = %.1f" %
+				(BGValueDonor_, BGValueAcceptor_))
+		elif ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[3]:
+			log_info("Background subtraction by rolling ball (radius = %d)" % rollingBall)
+		if roiCells_ is not None:
+			roiCells_.setName("cells-%04d" % (slic_ + 1))
+			roiCells_.setPosition(slic_ + 1)
+			cellROIs.append(roiCells_)
+		# Create dictionnary values for the frame 'slic+1'
+		BackThres = [str(slic_ + 1), ChoiceSub, BGValueDonor_, BGValueAcceptor_,
+			thresholds_[0], thresholds_[1], thresholdSource]
+		infoWriter.writerow(dict(zip(CSV_FIELDNAMES, BackThres)))
+		infoFile.flush()
+		usedBackROIs.append(backROI_)
+		usedThresholds.append(thresholds_)
+
+	needBackROI = ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[1]
+	ballEstimators = None
+	if ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[3] and ROLLING_BALL_APPROXIMATE:
+		ballEstimators = (RollingBallEstimator("donor", rollingBall),
+			RollingBallEstimator("acceptor", rollingBall))
+	# Frames can only be shared among threads if they do not reuse a background
+	framesIndependent = ballEstimators is None or ballEstimators[0].isStateless()
+	for slic in range(nbSlice):
+		# Once the background ROI and the thresholds are known for all the
+		# remaining frames, these frames are independent: run them in parallel
+		if PARALLEL_FRAMES and not STREAMING_MODE and nbSlice - slic > 1 \
+				and framesIndependent \
+				and (not needBackROI or frameBackROIs is not None or not doBleachROI) \
+				and (params_["manualThreshold"] or frameThresholds is not None or not doThreshold):
+			log_info("Process images %d-%d/%d in parallel" % (slic + 1, nbSlice, nbSlice))
+			frameSettings = [None] * nbSlice
+			for slicP in range(slic, nbSlice):
+				if frameBackROIs is not None:
+					backROI = frameBackROIs[slicP]
+				if params_["manualThreshold"] and (slicP == 0 or frameThresholds is None):
+					thres_min, thres_max = params_["thresholdValue"], maxVal
+				elif frameThresholds is not None:
+					thres_min, thres_max = frameThresholds[slicP]
+				frameSettings[slicP] = (backROI, (thres_min, thres_max))
+			results = processFramesParallel(stackDonor, stackAcceptor, stackFRET, slic,
+				frameSettings, params_, cellROIs is not None, ballEstimators)
+			for slicP in range(slic, nbSlice):
+				recordFrame(slicP, frameSettings[slicP][0], frameSettings[slicP][1], results[slicP])
+			statsAcceptor.invalidate()
+			break
+
+		if (nbSlice > 1) :
+			log_info("Process image %d/%d" % (slic + 1, nbSlice))
+
+		if STREAMING_MODE:
+			# Convert the frame number 'slic+1' in 32-bit into the channel buffers
+			impDonor_slice = readerDonor.getFrame(slic + 1)
+			impAcceptor_slice = readerAcceptor.getFrame(slic + 1)
+			maskFrame32(impDonor_slice.getProcessor(), 1, maxVal - 1)
+			maskFrame32(impAcceptor_slice.getProcessor(), 1, maxVal - 1)
+			if bleachModels[0] is not None:
+				bleachModels[0].correct(impDonor_slice.getProcessor(), slic)
+				bleachModels[1].correct(impAcceptor_slice.getProcessor(), slic)
+		else:
+			viewDonor.getProcessor().setPixels(stackDonor.getPixels(slic + 1))
+			viewAcceptor.getProcessor().setPixels(stackAcceptor.getPixels(slic + 1))
+			impDonor_slice = viewDonor
+			impAcceptor_slice = viewAcceptor
+
+
+		#Background subtraction
+		if frameBackROIs is not None:
+			backROI = frameBackROIs[slic]
+		elif needBackROI and doBleachROI :
+			# The ROI of the first frame may already come from the bleaching correction
+			if slic > 0 or backROI is None:
+				backROI = getBackgroundROI(impAcceptor_slice)
+			if (nbSlice>1) :
+				doBleachROI = not askSameForAllFrames("Same ROI ?",
+					"Do you want to use the same ROI for all the images")
+
+		if frameThresholds is not None:
+			thres_min, thres_max = frameThresholds[slic]
+		elif useAutoThreshold:
+			# Streaming: the histogram of the frame buffer, no duplicate
+			autoThresholdStats.append(getFrameStats(impAcceptor_slice.getProcessor()))
+			thres_min, thres_max = getAutoThresholds(autoThresholdStats[-1:], thresholdMethod)[0]
+		elif doThreshold and not params_["manualThreshold"]:
+			impT_slice = impAcceptor_slice.duplicate()
+			if STREAMING_MODE:
+				statsT = getFrameStats(impT_slice.getProcessor())
+			else:
+				statsT = statsAcceptor.getStats(slic + 1)
+			thres_min, thres_max = getThresholdInteractively(impT_slice, statsT)
+			impT_slice.close()
+			if nbSlice > 1:
+				doThreshold = not askSameForAllFrames("Same threshold values ?",
+					"Do you want to proceed automatically with the threshold values for all the images")
+			log_info("Threshold values: min = %.1f, max = %.1f" % (thres_min, thres_max))
+
+		if slic == 0 and params_["manualThreshold"] :
+			thres_min = params_["thresholdValue"]
+			thres_max = maxVal
+
+		ipFRET = None
+		if useFusedKernel:
+			if STREAMING_MODE:
+				ipFRET = buffersFRET[0]
+			else:
+				ipFRET = stackFRET.getProcessor(slic + 1)
+		result = processFrame(impDonor_slice, impAcceptor_slice, backROI,
+			(thres_min, thres_max), params_, cellROIs is not None, ipFRET, ballEstimators, slic)
+		recordFrame(slic, backROI, (thres_min, thres_max), result)
+
+		if STREAMING_MODE:
+			streamDonor.append(impDonor_slice.getProcessor())
+			streamAcceptor.append(impAcceptor_slice.getProcessor())
+			for m, FRETmetric in enumerate(FRETmetrics):
+				# The fused kernel has already written the first metric
+				if m > 0 or not useFusedKernel:
+					computeFRETPlane(impDonor_slice.getProcessor(), impAcceptor_slice.getProcessor(),
+						buffersFRET[m], FRETmetric)
+				streamsFRET[m].append(buffersFRET[m])
+				statsFrame = getFrameStats(buffersFRET[m], cal)
+				if statsFrame.min <= statsFrame.max:
+					statsMins[m] = min(statsMins[m], statsFrame.min)
+					statsMaxs[m] = max(statsMaxs[m], statsFrame.max)
+				addMeasurement(rts[m], statsFrame)
+				appendMeasurement(measureFiles[m], rts[m], rts[m].size() - 1)
+		else:
+			# Frames are processed in place; keep the result if a command replaced the array
+			stackDonor.setPixels(impDonor_slice.getProcessor().getPixels(), slic + 1)
+			stackAcceptor.setPixels(impAcceptor_slice.getProcessor().getPixels(), slic + 1)
+			statsAcceptor.invalidate(slic + 1)
+
+	infoFile.close()
+	log_info("Saved background/threshold log: infoFile.csv")
+	if cellROIs:
+		saveRoisZip(cellROIs, os.path.join(imageDir, CELL_ROIS_FILENAME))
+		log_info("Saved cell ROIs: " + CELL_ROIS_FILENAME)
+	elif cellROIs is not None:
+		# A zip file needs at least one entry
+		log_warning("No cell ROIs to save: no frame has thresholded cells")
+	if ballEstimators is not None:
+		saveRollingBallErrors(ballEstimators, os.path.join(imageDir, ROLLING_BALL_ERROR_FILENAME))
+		log_info("Saved approximate rolling ball errors: " + ROLLING_BALL_ERROR_FILENAME)
+	if AUTO_THRESHOLD_COMPARE and autoThresholdStats:
+		saveAutoThresholdComparison(autoThresholdStats,
+			os.path.join(imageDir, AUTO_THRESHOLD_COMPARE_FILENAME))
+		log_info("Saved automatic thresholds of all methods: " + AUTO_THRESHOLD_COMPARE_FILENAME)
+
+	saveAnalysisPreset(params_, usedBackROIs, usedThresholds,
+		os.path.join(imageDir, PRESET_FILENAME))
+
+	if STREAMING_MODE:
+		streamDonor.close()
+		streamAcceptor.close()
+		for m, FRETmetric in enumerate(FRETmetrics):
+			titleFRET, measureName, barName = FRETOutputs[m]
+			streamsFRET[m].close()
+			measureFiles[m].close()
+			log_info("Saved streamed stacks and FRET measurements: " + measureName)
+			if display_:
+				rts[m].show("Mean FRET index (%)" if m == 0 else "Mean " + titleFRET)
+			statsMin, statsMax = getFRETRange(statsMins[m], statsMaxs[m], FRETmetric)
+			if params_["calibrationBar"] and statsMin <= statsMax:
+				impBar = drawCalibrationBar(statsMin, statsMax)
+				IJ.run(impBar, DEFAULT_LUT, "")
+				if display_:
+					impBar.show()
+				writer_.submit(impBar, os.path.join(imageDir, barName))
+		return
+
+
+	#save thresholded Donor image
+	impDonor_OUT=ImagePlus(impDonor.getTitle(), stackDonor)
+	impDonor_OUT.setCalibration(cal)
+	impDonor_OUT.setDisplayRange(*getContrastRange(getFrameStats(stackDonor.getProcessor(1))))
+	writer_.submit(impDonor_OUT, os.path.join(imageDir, basename+"_c1thres.tif"), True)
+
+	#save thresholded Acceptor image
+	impAcceptor_OUT=ImagePlus(impAcceptor.getTitle(), stackAcceptor)
+	impAcceptor_OUT.setCalibration(cal)
+	impAcceptor_OUT.setDisplayRange(*getContrastRange(statsAcceptor.getStats(1)))
+	writer_.submit(impAcceptor_OUT, os.path.join(imageDir, basename+"_c2thres.tif"), True)
+
+	#### PART 3 :  FRET metric images
+	log_step("PART 3 : Measurement of " + ", ".join(m.strip() for m in FRETmetrics) + " - " + basename)
+
+	# The fused kernel has already computed the first metric frame by frame
+	computedMetrics = FRETmetrics[1:] if useFusedKernel else FRETmetrics
+	stacksFRET = None
+	if FRET_IN_PLACE and len(computedMetrics) == 1:
+		# The metric overwrites the acceptor stack: its queued write has to be finished first
+		writer_.waitFor(os.path.join(imageDir, basename+"_c2thres.tif"))
+		stacksFRET = [stackAcceptor]
+	impsFRET = []
+	if computedMetrics:
+		impsFRET = CalculationFRETmetrics(impDonor_OUT, impAcceptor_OUT, computedMetrics, stacksFRET)
+	if useFusedKernel:
+		impsFRET.insert(0, ImagePlus(FRETTitle, stackFRET))
+
+	for m, FRETmetric in enumerate(FRETmetrics):
+		impFRET = impsFRET[m]
+		titleFRET, measureName, barName = FRETOutputs[m]
+		impFRET.setTitle(titleFRET)
+
+		# One pass per FRET frame gives both the display range and the measurements
+		statsFRET = StackStatsCache(impFRET.getStack(), cal)
+		statsMin = Float.MAX_VALUE
+		statsMax = -Float.MAX_VALUE
+		for slic in range(nbSlice):
+			stats = statsFRET.getStats(slic + 1)
+			if stats.min <= stats.max:
+				statsMin = min(statsMin, stats.min)
+				statsMax = max(statsMax, stats.max)
+		statsMin, statsMax = getFRETRange(statsMin, statsMax, FRETmetric)
+
+		if statsMin <= statsMax:
+			impFRET.setDisplayRange(statsMin, statsMax)
+		impFRET.setCalibration(cal)
+		IJ.run(impFRET, DEFAULT_LUT, "stack")
+		writer_.submit(impFRET, os.path.join(imageDir, titleFRET), True)
+		if display_:
+			impFRET.show()
+		log_info("Queued FRET stack for saving: %s.tif" % titleFRET)
+
+		for slic in range(nbSlice):
+			addMeasurement(rts[m], statsFRET.getStats(slic + 1))
+
+		if display_:
+			rts[m].show("Mean FRET index (%)" if m == 0 else "Mean " + titleFRET)
+		rts[m].saveAs(os.path.join(imageDir, measureName))
+		log_info("Saved FRET measurements: " + measureName)
+
+		if params_["calibrationBar"] and statsMin <= statsMax:
+			impBar = drawCalibrationBar(statsMin, statsMax)
+			IJ.run(impBar, DEFAULT_LUT, "")
+			if display_:
+				impBar.show()
+			writer_.submit(impBar, os.path.join(imageDir, barName))
+			log_info("Queued FRET calibration bar for saving: " + barName)
+	return
+
+
+def getSeriesBasename(imagePath_, idxSeries_):
+	"""Return the output prefix (and folder name) of a series of a spectral file."""
+	basename_ = os.path.basename(os.path.splitext(imagePath_)[0]).replace(' ', '_').lower()
+	return basename_ + "_S" + adjustSizeNum(str(idxSeries_), 2)
+
+
+def runSeries(session_, idxSeries_, idxChannels_, params_, writer_, display_=True):
+	"""Extract donor/acceptor of one series, save the raw stacks and analyse them."""
+	basename_ = getSeriesBasename(session_.path, idxSeries_)
+	imageDir_ = createFolder(session_.path, basename_)
+	impDonor_, impAcceptor_ = extractImpsFromIndexes(session_, idxChannels_,
+		LOAD_AS_VIRTUAL_STACK, idxSeries_)
+	if LOAD_AS_VIRTUAL_STACK:
+		log_info("Donor and acceptor planes are read on demand (virtual stacks)")
+	IJ.run(impDonor_, "Grays", "stack")
+	IJ.run(impAcceptor_, "Grays", "stack")
+	# The raw images are saved by runAnalysis, after their display range is set
+	runAnalysis(impDonor_, impAcceptor_, imageDir_, basename_, params_, writer_, display_, True)
+
+
+class PipelineTask(Callable):
+	"""Run one pipeline job (a series or a donor/acceptor pair) on a worker pool."""
+
+	def __init__(self, label_, function_, *args_):
+		self.label = label_
+		self.function = function_
+		self.args = args_
+
+	def call(self):
+		try:
+			self.function(*self.args)
+			return True
+		except (Exception, Throwable), e:
+			log_error("%s failed: %s" % (self.label, e))
+			return False
+
+
+def runTasks(tasks_, poolSize_):
+	"""Run pipeline tasks on a fixed worker pool and return the number of failures."""
+	pool_ = Executors.newFixedThreadPool(poolSize_)
+	futures_ = [pool_.submit(task_) for task_ in tasks_]
+	nbFailed_ = 0
+	for future_ in futures_:
+		if not future_.get():
+			nbFailed_ += 1
+	pool_.shutdown()
+	return nbFailed_
+
+
+def getSeriesPoolSize(session_, nbSeries_):
+	"""Number of series analysed at once, bounded by the cores and the heap.
+
+	Each running series holds about SERIES_HEAP_FACTOR 32-bit copies of its
+	stack (thresholded donor/acceptor, FRET stack and one intermediate).
+	"""
+	runtime_ = Runtime.getRuntime()
+	bytesPerSeries_ = 1
+	for dims_ in session_.dims:
+		bytesPerSeries_ = max(bytesPerSeries_, 4 * SERIES_HEAP_FACTOR *
+			dims_["sizeX"] * dims_["sizeY"] * dims_["sizeZ"] * dims_["sizeT"])
+	heapSlots_ = int(runtime_.maxMemory() / bytesPerSeries_)
+	return max(1, min(nbSeries_, runtime_.availableProcessors(), heapSlots_))
+
+
+def runAllSeries(session_, idxChannels_, params_, writer_):
+	"""Analyse every series of the session in parallel on a worker pool.
+
+	All workers share the parsed metadata of the session and the same
+	analysis parameters; each series writes to its own basename_Sxx folder.
+	"""
+	nbSeries_ = session_.getSeriesCount()
+	poolSize_ = getSeriesPoolSize(session_, nbSeries_)
+	log_step("Analysis of %d series on %d workers" % (nbSeries_, poolSize_))
+	tasks_ = [PipelineTask("Series %d" % i, runSeries, session_, i, idxChannels_,
+		params_, writer_, False) for i in range(nbSeries_)]
+	nbFailed_ = runTasks(tasks_, poolSize_)
+	if nbFailed_ > 0:
+		log_warning("%d series could not be analysed" % nbFailed_)
+
+
+
+def runPair(donorPath_, acceptorPath_, params_, writer_, display_=True):
+	"""Open a donor/acceptor TIF pair and analyse it in a folder next to the donor."""
+	basename_ = os.path.basename(os.path.splitext(donorPath_)[0]).replace(' ', '_').lower()
+	imageDir_ = createFolder(donorPath_, basename_)
+	log_info("Donor file: %s" % donorPath_)
+	log_info("Acceptor file: %s" % acceptorPath_)
+	if LOAD_AS_VIRTUAL_STACK:
+		impDonor_ = IJ.openVirtual(donorPath_)
+		impAcceptor_ = IJ.openVirtual(acceptorPath_)
+	else:
+		impDonor_ = Opener().openImage(donorPath_)
+		impAcceptor_ = Opener().openImage(acceptorPath_)
+	runAnalysis(impDonor_, impAcceptor_, imageDir_, basename_, params_, writer_, display_)
+
+
+#### Headless batch mode
+
+def roiFromDict(roiDict_):
+	"""Rebuild a polygon ROI from its saved {"x": [...], "y": [...]} vertices."""
+	return PolygonRoi(FloatPolygon(jarray.array(roiDict_["x"], "f"),
+		jarray.array(roiDict_["y"], "f")), Roi.POLYGON)
+
+
+def roiToDict(roi_):
+	"""Save a ROI as the polygon vertices read by roiFromDict."""
+	poly_ = roi_.getFloatPolygon()
+	return {"x": [poly_.xpoints[i] for i in range(poly_.npoints)],
+		"y": [poly_.ypoints[i] for i in range(poly_.npoints)]}
+
+
+def saveAnalysisParameters(params_, path_):
+	"""Write a parameter set (JSON) that loadAnalysisParameters can replay."""
+	saved_ = dict(params_)
+	if saved_.get("backROI") is not None:
+		saved_["backROI"] = roiToDict(saved_["backROI"])
+	if saved_.get("frameBackROIs") is not None:
+		saved_["frameBackROIs"] = [roiToDict(r) for r in saved_["frameBackROIs"]]
+	with open(path_, "w") as jsonfile:
+		json.dump(saved_, jsonfile, indent=2, sort_keys=True)
+
+
+def saveAnalysisPreset(params_, usedBackROIs_, usedThresholds_, path_):
+	"""Record the choices of a run (one entry per frame) as an analysis preset.
+
+	Values that were the same for all frames are saved once; the per-frame
+	lists are kept only when the operator changed them during the run.
+	Threshold values are only recorded when they were chosen interactively:
+	an automatic method is computed again on each movie the preset is
+	replayed on.
+	"""
+	preset_ = dict(params_)
+	if usedBackROIs_ and usedBackROIs_[0] is not None:
+		preset_["backROI"] = usedBackROIs_[0]
+		if any(r is not usedBackROIs_[0] for r in usedBackROIs_):
+			preset_["frameBackROIs"] = usedBackROIs_
+	if usedThresholds_ and not preset_["manualThreshold"] \
+			and preset_["thresholdMethod"] == THRESHOLD_INTERACTIVE:
+		preset_["thresholds"] = usedThresholds_[0]
+		if len(set(usedThresholds_)) > 1:
+			preset_["frameThresholds"] = usedThresholds_
+	saveAnalysisParameters(preset_, path_)
+	log_info("Saved analysis preset: %s" % os.path.basename(path_))
+
+
+def loadAnalysisParameters(path_):
+	"""Read a saved parameter set (JSON) on top of the script dialog values.
+
+	The file uses the keys of getAnalysisParameters. For spectral files it
+	also holds "donorChannel" and "acceptorChannel" (1-based) and optionally
+	"series" (list of 0-based indices, all series when missing). "backROI"
+	is stored as polygon vertices and "thresholds" as [min, max].
+	"FRETchoice" and "extraFRETMetrics" may name the metrics by index in
+	FRET_METRICS or by name. The analysis presets saved by
+	saveAnalysisPreset use the same format.
+	"""
+	with open(path_) as jsonfile:
+		saved_ = json.load(jsonfile)
+	params_ = getAnalysisParameters()
+	params_.update(saved_)
+	if saved_.get("backROI") is not None:
+		params_["backROI"] = roiFromDict(saved_["backROI"])
+	if saved_.get("thresholds") is not None:
+		params_["thresholds"] = tuple(saved_["thresholds"])
+	if saved_.get("frameBackROIs") is not None:
+		params_["frameBackROIs"] = [roiFromDict(r) for r in saved_["frameBackROIs"]]
+	if saved_.get("frameThresholds") is not None:
+		params_["frameThresholds"] = [tuple(t) for t in saved_["frameThresholds"]]
+	# FRET metrics may be given by index or by name, with or without padding
+	choice_ = getFRETMetricIndex(params_["FRETchoice"])
+	if choice_ is not None:
+		params_["FRETchoice"] = FRET_METRICS[choice_]
+	return params_
+
+
+def checkFRETMetrics(params_):
+	"""Check that the FRET metrics of a parameter set are all in FRET_METRICS."""
+	unknown_ = [m_ for m_ in [params_["FRETchoice"]] + list(params_["extraFRETMetrics"])
+		if getFRETMetricIndex(m_) is None]
+	for metric_ in unknown_:
+		log_error("Parameter set has an unknown FRET metric: %s" % metric_)
+	return len(unknown_) == 0
+
+
+def checkBatchParameters(params_, needChannels_):
+	"""Check that a parameter set answers every question asked by a dialog."""
+	missing_ = []
+	if needsBackgroundROI(params_) and params_["backROI"] is None:
+		missing_.append("backROI")
+	if not params_["manualThreshold"] and params_["thresholds"] is None \
+			and params_["thresholdMethod"] == THRESHOLD_INTERACTIVE:
+		missing_.append("thresholds")
+	if needChannels_:
+		for key_ in ("donorChannel", "acceptorChannel"):
+			if params_.get(key_) is None:
+				missing_.append(key_)
+	for key_ in missing_:
+		log_error("Parameter set has no value for '%s'" % key_)
+	return checkFRETMetrics(params_) and len(missing_) == 0
+
+
+def findBatchInputs(batchInput_):
+	"""List the spectral files and donor/acceptor TIF pairs of a folder or glob.
+
+	Returns
+	-------
+	spectral_ : list of str
+		LSM/CZI files.
+	pairs_ : list of (str, str)
+		Donor "*_c1.tif" files with their "*_c2.tif" acceptor.
+	"""
+	if os.path.isdir(batchInput_):
+		paths_ = [os.path.join(batchInput_, f) for f in os.listdir(batchInput_)]
+	else:
+		paths_ = glob.glob(batchInput_)
+	paths_.sort()
+	spectral_ = [p for p in paths_ if p.lower().endswith(BATCH_SPECTRAL_EXTENSIONS)]
+	pairs_ = []
+	for path_ in paths_:
+		if path_.lower().endswith(BATCH_DONOR_SUFFIX):
+			acceptorPath_ = path_[:-len(BATCH_DONOR_SUFFIX)] + BATCH_ACCEPTOR_SUFFIX
+			if os.path.exists(acceptorPath_):
+				pairs_.append((path_, acceptorPath_))
+			else:
+				log_warning("No acceptor file for %s" % path_)
+	return spectral_, pairs_
+
+
+def runBatch(batchInput_, parameterFile_, writer_):
+	"""Analyse a folder (or glob) of files without any dialog.
+
+	Every series of every spectral file and every donor/acceptor pair is a
+	job of a worker pool; the output layout is the one of interactive runs.
+
+	Returns
+	-------
+	list of SpectralReaderSession
+		Sessions to close once the output writer is drained.
+	"""
+	log_step("Headless batch analysis: " + batchInput_)
+	params_ = loadAnalysisParameters(parameterFile_)
+	spectral_, pairs_ = findBatchInputs(batchInput_)
+	log_info("Found %d spectral files and %d donor/acceptor pairs" %
+		(len(spectral_), len(pairs_)))
+	if not checkBatchParameters(params_, len(spectral_) > 0):
+		return []
+
+	sessions_ = []
+	tasks_ = []
+	channels_ = [params_.get("donorChannel"), params_.get("acceptorChannel")]
+	for path_ in spectral_:
+		session_ = openReaderSession(path_)
+		sessions_.append(session_)
+		series_ = params_.get("series")
+		if series_ is None:
+			series_ = range(session_.getSeriesCount())
+		for i in series_:
+			tasks_.append(PipelineTask("%s series %d" % (path_, i), runSeries,
+				session_, i, channels_, params_, writer_, False))
+	for donorPath_, acceptorPath_ in pairs_:
+		tasks_.append(PipelineTask(donorPath_, runPair, donorPath_, acceptorPath_,
+			params_, writer_, False))
+
+	poolSize_ = BATCH_WORKERS
+	if poolSize_ <= 0:
+		poolSize_ = Runtime.getRuntime().availableProcessors()
+	poolSize_ = max(1, min(poolSize_, len(tasks_)))
+	log_info("Running %d jobs on %d workers" % (len(tasks_), poolSize_))
+	nbFailed_ = runTasks(tasks_, poolSize_)
+	if nbFailed_ > 0:
+		log_warning("%d batch jobs failed" % nbFailed_)
+	return sessions_
+
+
 # ---------------------------------------------------------------------------
 # MAIN SCRIPT
 # ---------------------------------------------------------------------------
@@ -553,7 +2992,10 @@ try:
 	uiService.getDefaultUI().getConsolePane().clear()
 except:
 	pass
-	
+
+
+# Background writer for all saved TIFFs (waited for at the end of the script)
+outputWriter = AsyncTiffWriter(WRITE_QUEUE_MAX_MB)
 
 # Close Results Table if opened
 if IJ.isResultsWindow():
@@ -562,295 +3004,116 @@ if IJ.isResultsWindow():
 	if tw is not None:
 		tw.close()
 
-## Input handling: spectral LSM vs. separate donor/acceptor images
+# Measurements and CSV format shared by all analysed datasets
+Analyzer.setMeasurements(Measurements.AREA + Measurements.MEAN + Measurements.STD_DEV)
+Analyzer.setPrecision(5)
+IJ.run("Input/Output...", "jpeg=85 gif=-1 file=.csv save_column")
+
+params = getAnalysisParameters()
+if parameterFile and not batchInput:
+	# Replay a preset recorded by an earlier run: no dialog for the recorded choices
+	params = loadAnalysisParameters(parameterFile)
+	log_info("Replaying analysis preset: %s" % parameterFile)
+	if not checkFRETMetrics(params):
+		log_error("Invalid analysis preset. Aborting.")
+		sys.exit(0)
+
+## Input handling: headless batch, spectral LSM or separate donor/acceptor images
+
+sessions = []
+if batchInput :
+	if not parameterFile:
+		log_error("The batch mode needs a parameter set (parameterFile). Aborting.")
+		sys.exit(0)
+	sessions = runBatch(batchInput, parameterFile, outputWriter)
+
+elif fileType == "Spectral Confocal LSM/CZI   " :
 
-if fileType == "Spectral Confocal LSM/CZI   " :
-	
 	od = OpenDialog("Select a spectral LSM image", None)
 	lsmPath = od.getPath()
 	if lsmPath is None:
 		log_warning("No LSM file selected. Aborting.")
-		sys.exit(0)	
+		sys.exit(0)
 	log_info("Input LSM file: %s" % lsmPath)
-	
-	# initialite the reader and get the OME metadata
-	reader = ImageReader()
-	omeMeta = MetadataTools.createOMEXMLMetadata()
-	reader.setMetadataStore(omeMeta)
-	reader.setId(lsmPath)
-	sizeC = reader.getSizeC()
-	sizeT = reader.getSizeT()
-	sizeZ = reader.getSizeZ()
-	seriesCount = reader.getSeriesCount()
-	reader.close()
+
+	# Open the file once: the same reader session serves the metadata probe,
+	# the spectrum preview and the donor/acceptor planes
+	session = openReaderSession(lsmPath)
+	sessions.append(session)
+	sizeC = session.getSizeC()
+	sizeT = session.getSizeT()
+	sizeZ = session.getSizeZ()
+	seriesCount = session.getSeriesCount()
 	log_info("Detected dimensions: C=%d, Z=%d, T=%d, series=%d" %
 		(sizeC, sizeZ, sizeT, seriesCount))
-	
-	
+
+
 	#select the serie if several
 	idxSerie=0
+	allSeries = False
 	if seriesCount>1 :
 		gui = GenericDialog("Select image serie")
 		gui.addSlider("Image series: ", 1, seriesCount, 3)
+		gui.addCheckbox("Process all series in parallel (same channels and parameters)", False)
 		gui.showDialog()
 		idxSerie = int(gui.getNextNumber()-1)
+		allSeries = gui.getNextBoolean()
 		log_info("Selected series index: %d" % idxSerie)
-	
+	session.setSeries(idxSerie)
+
 	#Create Folder for Donor and Acceptor images
-	basename = os.path.basename(os.path.splitext(lsmPath)[0]).replace(' ', '_').lower()
-	basename += "_S" + adjustSizeNum(str(idxSerie), 2)
+	basename = getSeriesBasename(lsmPath, idxSerie)
 	imageDir = createFolder(lsmPath , basename)
 
 	#Open a menu for selecting Donor and Acceptor image indexes
-	log_info("Select donor and acceptor channels...")
-	idxDonor, idxAcceptor = getImpIndexes(lsmPath,sizeC, sizeZ, sizeT, idxSerie, SELECT_CHANNELS_INTERACTIVELY, imageDir)
- 	
-
-	#Extract Donor and Acceptor images 
-	log_step("Extract donor and acceptor image stacks")
-	impDonor = extractImpFromIndex(lsmPath, idxDonor, idxSerie)
-	impAcceptor = extractImpFromIndex(lsmPath, idxAcceptor, idxSerie)
-
-	
-	IJ.run(impDonor, "Grays", "stack")
-	IJ.run(impAcceptor, "Grays", "stack")
-	#Save Donor and Acceptor raw images
-	IJ.saveAs(impDonor, "TIFF",os.path.join(imageDir, basename+"_c1.tif")) 
-	IJ.saveAs(impAcceptor, "TIFF",os.path.join(imageDir, basename+"_c2.tif")) 
-	log_info("Saved raw donor and acceptor images.")
-
-else : 
+	if params.get("donorChannel") is not None and params.get("acceptorChannel") is not None:
+		idxDonor = int(params["donorChannel"])
+		idxAcceptor = int(params["acceptorChannel"])
+		log_info("Donor/acceptor channels from preset: %d/%d" % (idxDonor, idxAcceptor))
+	else:
+		log_info("Select donor and acceptor channels...")
+		idxDonor, idxAcceptor = getImpIndexes(session, SELECT_CHANNELS_INTERACTIVELY, imageDir, outputWriter)
+		params["donorChannel"] = idxDonor
+		params["acceptorChannel"] = idxAcceptor
+
+	if allSeries:
+		# Background ROI and threshold are chosen once, on the selected series,
+		# then shared by the workers of all series
+		impDonor, impAcceptor = extractImpsFromIndexes(session, [idxDonor, idxAcceptor], True)
+		collectFrameParameters(impDonor, impAcceptor, params)
+		runAllSeries(session, [idxDonor, idxAcceptor], params, outputWriter)
+	else:
+		#Extract Donor and Acceptor images, then run PART 2 and PART 3
+		log_step("Extract donor and acceptor image stacks")
+		runSeries(session, idxSerie, [idxDonor, idxAcceptor], params, outputWriter)
+
+else :
 	log_step("Input from separate donor/acceptor TIF files")
 	gui = GenericDialogPlus("Select the Donor/Acceptor images")
 	gui.addFileField("Select the donor file", prefs.get(None, "dir.donor", "DefaultImage"))
 	gui.addFileField("Select the acceptor file", prefs.get(None, "dir.acceptor", "DefaultImage"))
-	
+
 	gui.showDialog()
 	if gui.wasOKed():
 	    donorPath   = gui.getNextString()
 	    acceptorPath = gui.getNextString()
-	    prefs.put(None, "dir.donor", donorPath) 
-	    prefs.put(None, "dir.acceptor", acceptorPath) 
+	    prefs.put(None, "dir.donor", donorPath)
+	    prefs.put(None, "dir.acceptor", acceptorPath)
 	else :
 		log_warning("User cancelled donor/acceptor file selection. Aborting.")
 		sys.exit(0)
-	
-	
-	#create folder for analysis 
-	basename = os.path.basename(os.path.splitext(donorPath)[0]).replace(' ', '_').lower()
-	imageDir = createFolder(donorPath , basename)
-
-	#open the files 
-	log_info("Donor file: %s" % donorPath)
-	log_info("Acceptor file: %s" % acceptorPath)
-	impDonor = Opener().openImage(donorPath)
-	impAcceptor = Opener().openImage(acceptorPath)
-
-## Calibration and stack properties
-
-cal = impAcceptor.getCalibration()
-unit = cal.getUnit()
-if unit =="micron" :
-	unit ="um"
-pix2phys = cal.getX(1)	
-
-
-# Get width, height, frame, bit depth 
-nbSlice = impAcceptor.getStackSize()
-width = impAcceptor.width
-height = impAcceptor.height
-depth = impAcceptor.getBitDepth()
-log_info("Stack size: %d slices, width=%d, height=%d, bit-depth=%d"
-	% (nbSlice, width, height, depth))
-
-# Create  Image stack 
-stackDonor = ImageStack(width, height)
-stackAcceptor = stackDonor.duplicate()
-
-
-IJ.run(impDonor, "Enhance Contrast", "saturated=0.35")	
-IJ.run(impAcceptor, "Enhance Contrast", "saturated=0.35")	
-
-
-#### PART 2 :  Bleaching correction and substract background 
-log_step("PART 2 : Bleaching correction and background subtraction")
-
-doBleachROI = True
-doThreshold = True
-# Create Array of Dictionnary for Background/Threshold  CSV File
-infoImg = []
-for slic in range(nbSlice): 
-	if (nbSlice > 1) :
-		log_info("Process image %d/%d" % (slic + 1, nbSlice))
-		
-	# Duplicate the frame number 'slic+1' and convert the image in 32-bit
-	impDonor.setSlice(slic+1)
-	impDonor_slice = impDonor.crop("whole-slice")
-	ImageConverter(impDonor_slice).convertToGray32()
-	impAcceptor.setSlice(slic+1)
-	impAcceptor_slice = impAcceptor.crop("whole-slice")
-	ImageConverter(impAcceptor_slice).convertToGray32()
-	
-	#Check the bit depth of the images and remove saturated and null pixels (saturated pixel are above  2^depth )
-	if slic == 0 and depth > 8 :
-		maxPix = impAcceptor_slice.getStatistics(Measurements.MIN_MAX).max
-		if maxPix < 4096 :
-			depth = 12 # the camera is 12-bits dynamical range =[0,4095]
-	maxVal = math.pow(2,depth)-1
-	
-	applyThreshold(impDonor_slice, 1,  maxVal - 1)
-	applyThreshold(impAcceptor_slice, 1,  maxVal - 1)
 
-	
-	#Background subtraction
-	if (bleachCorr or ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[1]) and doBleachROI :
-		backROI = getBackgroundROI(impAcceptor_slice)
-		if (nbSlice>1) :
-			dial = YesNoCancelDialog(IJ.getInstance(), "Same ROI ?",
-				"Do you want to use the same ROI for all the images",
-				"  Yes  ", "  No  ")
-			doBleachROI = not dial.yesPressed() 
-	
-	if bleachCorr:
-		if nbSlice > 1:
-			log_info("Correction of the photobleaching")
-			CorrectionMethodIdx = CORRECTION_METHODS.index(CorrectionMethod)
-			impDonor = bleachCorrection(impDonor_slice, CorrectionMethodIdx, backROI)
-			impAcceptor = bleachCorrection(impAcceptor_slice, CorrectionMethodIdx, backROI)
-		else:
-			log_info("No photobleaching correction because raw data is not a stack")
-	
-	impT_slice = impAcceptor_slice.duplicate()
-	if doThreshold and not manualThreshold:
-		IJ.run(impT_slice, "Enhance Contrast", "saturated=0.35")	
-		impT_slice.show()
-		ta = ThresholdAdjuster()
-		ta.show()
-		ta.update()
-		IJ.setAutoThreshold(impT_slice, "Moments dark")
-		waitDialog = WaitForUserDialog("Manual threshold",
-			"Please, adjust the threshold as desired, then press 'OK' (do not press 'Apply')")
-		waitDialog.show()
-		thres_min = impT_slice.getProcessor().getMinThreshold()
-		thres_max = impT_slice.getProcessor().getMaxThreshold()
-		ta.close()
-		impT_slice.hide()
-		if nbSlice > 1:
-			d = YesNoCancelDialog(IJ.getInstance(), "Same threshold values ?",
-				"Do you want to proceed automatically with the threshold values for all the images",
-				"  Yes  ", "  No  ")
-			doThreshold = not d.yesPressed()
-		log_info("Threshold values: min = %.1f, max = %.1f" % (thres_min, thres_max))
-		
-	if slic == 0 and manualThreshold :
-		thres_min = thresholdValue
-		thres_max = maxVal
-		
-	IJ.setThreshold(impT_slice, thres_min, thres_max)
-	roiCells = ThresholdToSelection.run(impT_slice) # Threshold selection in the image = signal
-	roiNan = roiCells.getInverse(impT_slice) #get the inverse roi of  roiCells = Background
-	impT_slice.close()
-	
-	if ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[0]:
-		IJ.run(impDonor_slice, "Subtract...", "value=" + str(BGValueDonor) + " slice")
-		IJ.run(impAcceptor_slice, "Subtract...", "value=" + str(BGValueAcceptor) + " slice")
-	elif ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[1]:
-		BGValueDonor = subtractBG(impDonor_slice, backROI)
-		BGValueAcceptor = subtractBG(impAcceptor_slice, backROI)
-		log_info("Background donor = %.1f, acceptor = %.1f" %
-			(BGValueDonor, BGValueAcceptor))
-	elif ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[2]:
-		BGValueDonor = subtractBG(impDonor_slice, roiNan)
-		BGValueAcceptor = subtractBG(impAcceptor_slice, roiNan)
-		log_info("Background donor = %.1f, acceptor = %.1f" %
-			(BGValueDonor, BGValueAcceptor))
-	elif ChoiceSub == BACKGROUND_SUBTRACTION_METHODS[3]:
-		IJ.run(impDonor_slice, "Subtract Background...", "rolling=" + str(rollingBall) + " stack")
-		IJ.run(impAcceptor_slice, "Subtract Background...", "rolling=" + str(rollingBall) + " stack")
-		BGValueDonor = rollingBall
-		BGValueAcceptor = rollingBall
-		log_info("Background subtraction by rolling ball (radius = %d)" % rollingBall)
-
-	# Convert roiNan in NaN values in all images
-	applyROI2NAN(impDonor_slice,roiNan)
-	applyROI2NAN(impAcceptor_slice,roiNan)
-
-	# Create dictionnary values for the frame 'slic+1'
-	BackThres = [str(slic + 1), ChoiceSub, BGValueDonor, BGValueAcceptor,
-		thres_min, thres_max]
-	infoImg.append(dict(zip(CSV_FIELDNAMES, BackThres)))
-
-	stackDonor.addSlice(impDonor_slice.getProcessor())
-	stackAcceptor.addSlice(impAcceptor_slice.getProcessor())
-
-with open(os.path.join(imageDir, "infoFile.csv"), "wb") as csvfile:
-	writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
-	writer.writeheader()
-	writer.writerows(infoImg)
-
-log_info("Saved background/threshold log: infoFile.csv")
-
- 
-#save thresholded Donor image
-impDonor_OUT=ImagePlus(impDonor.getTitle(), stackDonor)
-IJ.run(impDonor_OUT, "Enhance Contrast", "saturated=0.35 stack")
-IJ.saveAs(impDonor_OUT, "TIFF",os.path.join(imageDir, basename+"_c1thres.tif")) 
-
-#save thresholded Acceptor image
-impAcceptor_OUT=ImagePlus(impAcceptor.getTitle(), stackAcceptor)
-IJ.run(impAcceptor_OUT, "Enhance Contrast", "saturated=0.35 stack")
-IJ.saveAs(impAcceptor_OUT, "TIFF",os.path.join(imageDir, basename+"_c2thres.tif"))
-	
-#### PART 3 :  FRET metric images	
-log_step("PART 3 : Measurement of " + FRETchoice)
-
-metric = "ratio"
-if FRETchoice == FRET_METRICS[0]:
-	metric = "index"
-elif FRETchoice == FRET_METRICS[1]:
-	metric += "A_D"
-else:
-	metric += "D_A"
-	
-
-impFRET = CalculationFRETmetric(impDonor_OUT, impAcceptor_OUT, FRETchoice)
-FRETTitle = "FRET_" + metric + "_" + os.path.basename(basename)
-impFRET.setTitle(FRETTitle)
+	#create folder for analysis, open the files and run PART 2 and PART 3
+	runPair(donorPath, acceptorPath, params, outputWriter)
 
-stats = impFRET.getStatistics(Measurements.MIN_MAX)
-statsMax = stats.max
-statsMin = stats.min
-if FRETchoice == FRET_METRICS[0]:
-	statsMax = math.ceil(stats.max)
-	statsMin = math.floor(stats.min)
+# Wait for the queued TIFFs (the raw virtual stacks still read from the session)
+log_info("Waiting for the output writer...")
+if outputWriter.drain():
+	log_info("All images saved.")
 
-impFRET.setDisplayRange(statsMin, statsMax)
-impFRET.setCalibration(cal)
-IJ.run(impFRET, DEFAULT_LUT, "stack")
-IJ.saveAs(impFRET, "TIFF", os.path.join(imageDir, FRETTitle))
-impFRET.show()
-log_info("Saved FRET stack: %s.tif" % FRETTitle)
-
-Analyzer.setMeasurements(Measurements.AREA + Measurements.MEAN + Measurements.STD_DEV)
-Analyzer.setPrecision(5)
-rt = ResultsTable()
-for slic in range(nbSlice):
-	impFRET.setSlice(slic + 1)
-	impFRET_slice = impFRET.crop("whole-slice")
-	analyzer = Analyzer(impFRET_slice, rt)
-	analyzer.measure()
-
-rt.show("Mean FRET index (%)")
-IJ.run("Input/Output...", "jpeg=85 gif=-1 file=.csv save_column")
-rt.saveAs(os.path.join(imageDir, "MeanFRETindex.csv"))
-log_info("Saved FRET measurements: MeanFRETindex.csv")
-
-if calibrationBar:
-	impBar = drawCalibrationBar(statsMin, statsMax)
-	IJ.run(impBar, DEFAULT_LUT, "")
-	impBar.show()
-	IJ.saveAs(impBar, "TIFF", os.path.join(imageDir, "FRET_CalibrationBar"))
-	log_info("Saved FRET calibration bar.")
+# Release the readers kept open for the virtual stacks
+for session in sessions:
+	session.close()
 
 log_step("End of analysis")
 log_info("FRET_LSM_Timelapse script completed successfully.")